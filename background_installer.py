@@ -11,14 +11,178 @@ import time
 import sys
 import os
 import logging
+import logging.handlers
 import atexit
 import signal
+import json
+import hashlib
+import shutil
+import asyncio
+import selectors
+import select
+import resource
+import tempfile
+import cProfile
+import pstats
+import tracemalloc
+import io
+import socket
+import threading
+import struct
+import fcntl
+import gzip
+import ctypes
+import heapq
+from contextlib import contextmanager
+from collections import deque
 from datetime import datetime
 
+# python-apt is optional (see --libapt); without it every operation shells out to apt/dpkg
+try:
+    import apt
+    import apt_pkg
+    import apt.progress.base
+except ImportError:
+    apt = None
+
 # Global flag for graceful shutdown
 shutdown_flag = False
+# Set with shutdown_flag while the batch loop runs, so waits end at once
+shutdown_event = None
+# Control API events: skip-hold ends the current wait, pause clears unpaused
+skip_event = None
+unpaused_event = None
 pid_file = "/tmp/background_batch_installer.pid"
 log_file = "/tmp/background_batch_installer.log"
+cache_file = "/var/lib/background_installer/catalogue.cache"
+timings_file = "/tmp/background_batch_installer.timings.jsonl"
+textfile_dir = "/var/lib/prometheus/node-exporter"
+profile_file = "/tmp/background_batch_installer.pstats"
+tracemalloc_file = "/tmp/background_batch_installer.tracemalloc"
+apt_lists_dir = "/var/lib/apt/lists"
+archive_dir = "/var/cache/apt/archives"
+mirror_dir = "/var/cache/background_installer/mirror"
+update_stamp_file = "/var/lib/background_installer/lists.updated"
+journal_file = "/var/lib/background_installer/session.journal"
+control_socket = "/tmp/background_batch_installer.sock"
+config_file = "/etc/background_installer.json"
+apt_success_stamp = "/var/lib/apt/periodic/update-success-stamp"
+dpkg_lock_file = "/var/lib/dpkg/lock-frontend"
+
+# Runtime options, read from config_file (see load_config) and the command line
+config = {
+    'swap_mode': False,   # purge batch N and install batch N+1 in one apt run
+    'libapt': False,   # use python-apt in-process (apt timeouts are not enforced there)
+    'archive_budget_mb': 4096,   # size cap for retained .debs in archive_dir
+    'mirror_mode': False,   # install only from the local flat repo in mirror_dir
+    'update_max_age_minutes': 360,   # skip apt update if lists are newer than this
+    'metrics_file': None,   # Prometheus textfile; default picks textfile_dir or /tmp
+    'profile': False,   # run under cProfile and tracemalloc
+    'profile_interval': 600,   # seconds between interim profile dumps
+    'stop_grace_seconds': 900,   # how long 'stop' lets a running apt transaction finish
+    'log_max_mb': 50,   # rotate the log past this size (0 disables rotation)
+    'log_backups': 5,   # compressed rotated logs to keep
+    # Session shape and cadence; [low, high] ranges are sampled uniformly
+    'total_apps': [161, 199],
+    'batch_size': [5, 14],
+    'hold_minutes': [7, 16],   # how long a batch stays installed
+    'delay_seconds': [60, 180],   # pause between removing a batch and the next install
+    'cleanup_every': 3,   # autoremove and prune the archive cache every Nth batch
+    # apt timeouts, seconds
+    'update_timeout': 300,
+    'install_timeout': 600,
+    'remove_timeout': 300,
+    'swap_timeout': 900,
+    'cleanup_timeout': 180,
+    'download_timeout': 600,
+    'retry_install_timeout': 180,   # per package when bisecting a failed install
+    'retry_remove_timeout': 60,   # per package when bisecting a failed removal
+    'lock_wait_timeout': 1800,   # give up on a dpkg lock held by someone else after this
+    # Load-adaptive throttling (see throttle_level)
+    'throttle': True,   # adapt batch size, holds and install timing to host load
+    'pressure_high': 20,   # PSI "some" avg10 percent at which the host counts as busy
+    'pressure_idle': 2,   # ... and at or below which it counts as idle
+    'load_high_pct': 150,   # 1-minute load average per CPU, percent
+    'load_idle_pct': 50,
+    'mem_low_pct': 10,   # MemAvailable below this share of RAM counts as busy
+    'defer_max_minutes': 30,   # longest an install waits for a busy host to calm down
+    'hold_stretch_pct': 150,   # holds and delays on a busy host, percent of the drawn value
+    'load_settle_seconds': 60,   # let our own apt run fade from PSI and load average before reading them
+}
+config_defaults = dict(config)
+
+# Options given on the command line win over config_file, also on reload
+config_overrides = {}
+
+# Settings a reload cannot change in a running daemon
+STARTUP_ONLY = ('mirror_mode', 'libapt', 'metrics_file', 'profile', 'log_max_mb', 'log_backups')
+
+# SIGHUP arrived before the batch loop could handle it
+reload_pending = False
+
+# clock.monotonic() when the last dpkg step of run_batches finished (None before the first)
+dpkg_step_end = None
+
+# cProfile.Profile while running with --profile
+profiler = None
+last_profile_dump = 0.0
+
+# pstats.Stats merged from the worker-thread steps run under --profile
+worker_stats = None
+worker_stats_lock = threading.Lock()
+
+# Live progress of the running apt transaction, fed from APT::Status-Fd
+apt_progress = {'phase': 'idle', 'percent': 0.0, 'message': '', 'since': 0.0}
+
+# Cumulative seconds spent in each apt phase (resolve, download, unpack, ...)
+apt_phase_seconds = {}
+
+# Batch the session is currently working on, for timing records
+current_batch = 0
+timings_lock = threading.Lock()
+
+# Lines of apt output kept for error reporting
+OUTPUT_TAIL_LINES = 50
+
+# Archive cache lookups for the session: a hit is a .deb already on disk
+archive_stats = {'hits': 0, 'misses': 0, 'miss_bytes': 0}
+
+# Times we found the dpkg lock taken by another process, and seconds queued
+lock_stats = {'waits': 0, 'seconds': 0.0}
+
+# Resource usage of reaped children: session total, per batch and per package
+usage_total = {}
+usage_by_batch = {}
+usage_by_package = {}
+usage_lock = threading.Lock()
+
+# Session progress shared by the batch loop, metrics and status reporting
+session = {
+    'state': 'idle',
+    'batches': 0,
+    'processed_apps': 0,
+    'total_apps': 0,
+    'batch_apps': [],
+    'wait_until': None,   # end of the current hold/delay, epoch seconds
+    'started': None,   # when this process started batches, epoch seconds
+    'started_apps': 0,   # processed_apps at that point (non-zero on resume)
+    'throttle': 'normal',   # last throttle_level(): idle, normal or high
+}
+
+# Prometheus counters and phase duration histograms
+SESSION_STATES = ('idle', 'updating', 'installing', 'holding', 'removing',
+                  'swapping', 'waiting', 'cleaning', 'paused', 'deferred')
+THROTTLE_LEVELS = ('idle', 'normal', 'high')
+PHASE_BUCKETS = (1, 5, 15, 60, 180, 300, 600, 900, 1800, 3600)
+result_counts = {}
+phase_histograms = {}
+metrics_lock = threading.Lock()
+
+# In-process libapt backend (None unless enabled with --libapt and python-apt is available)
+apt_backend = None
+
+# Available catalogue packages -> candidate metadata, built once per session
+package_index = None
 
 # Updated package list for Ubuntu 24.04 (Noble Numbat)
 # Only packages that definitely exist in Ubuntu 24.04 repos
@@ -447,12 +611,97 @@ def daemonize():
     # Set up signal handlers
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
 
 def signal_handler(signum, frame):
     """Handle shutdown signals gracefully"""
     global shutdown_flag
     shutdown_flag = True
 
+def reload_handler(signum, frame):
+    """Remember a SIGHUP until the batch loop can reload the config"""
+    global reload_pending
+    reload_pending = True
+
+def load_config(missing_ok=True):
+    """Return the defaults overlaid with config_file and command-line options
+    
+    config_file is a JSON object of config keys; a missing file is fine at
+    startup (missing_ok). Raises ValueError (or OSError) for a file that
+    cannot be used.
+    """
+    try:
+        with open(config_file, 'r') as f:
+            values = json.load(f)
+    except FileNotFoundError:
+        if not missing_ok:
+            raise
+        values = {}
+    if not isinstance(values, dict):
+        raise ValueError(f"{config_file} must contain a JSON object")
+    
+    new = dict(config_defaults)
+    for key, value in values.items():
+        if key not in config_defaults:
+            raise ValueError(f"unknown setting {key!r}")
+        default = config_defaults[key]
+        # An empty batch or a zero timeout would stall the session; cleanup_every is a divisor
+        minimum = 1 if key in ('total_apps', 'batch_size', 'cleanup_every') or key.endswith('_timeout') else 0
+        if isinstance(default, list):
+            valid = (isinstance(value, list) and len(value) == 2
+                     and all(type(v) is int and v >= minimum for v in value) and value[0] <= value[1])
+        elif isinstance(default, bool):
+            valid = isinstance(value, bool)
+        elif default is None:
+            valid = value is None or isinstance(value, str)
+        else:
+            valid = type(value) is int and value >= minimum
+        if not valid:
+            raise ValueError(f"invalid value for {key!r}: {value!r}")
+        new[key] = value
+    new.update(config_overrides)
+    return new
+
+def reload_config(logger):
+    """Re-read config_file into the running session; returns (ok, changes or error)
+    
+    Changes apply from the next batch, wait or apt run on; the session's
+    total_apps is already chosen and stays.
+    """
+    global reload_pending
+    reload_pending = False
+    try:
+        # A file gone missing must not quietly reset everything to the defaults
+        new = load_config(missing_ok=False)
+    except (OSError, ValueError) as e:
+        logger.error(f"✗ Config reload failed, keeping current settings: {e}")
+        return False, str(e)
+    
+    changes = {}
+    for key, value in new.items():
+        if config[key] == value:
+            continue
+        if key in STARTUP_ONLY:
+            logger.warning(f"⚠ {key} cannot change while running, restart to apply")
+            continue
+        changes[key] = value
+    config.update(changes)
+    summary = ', '.join(f"{key}={value}" for key, value in changes.items()) or "no changes"
+    logger.info(f"Config reloaded from {config_file}: {summary}")
+    return True, changes
+
+def request_shutdown():
+    """Stop the session: waits end at once, a running apt transaction finishes
+    
+    Installed as the event loop's SIGTERM/SIGINT handler while batches run.
+    """
+    global shutdown_flag
+    if not shutdown_flag and session['state'] in ('installing', 'removing', 'swapping', 'cleaning'):
+        logging.getLogger(__name__).info("Shutdown requested, letting the running apt transaction finish...")
+    shutdown_flag = True
+    if shutdown_event is not None:
+        shutdown_event.set()
+
 def cleanup_pid_file():
     """Remove PID file on exit"""
     if os.path.exists(pid_file):
@@ -482,30 +731,1235 @@ def check_existing_process():
 def setup_logging():
     """Setup logging for background process"""
     # Configure logging
+    if config['log_max_mb'] > 0:
+        handler = LogRotator(
+            log_file,
+            maxBytes=config['log_max_mb'] * 1024 * 1024,
+            backupCount=config['log_backups']
+        )
+        handler.namer = lambda name: name + '.gz'
+        handler.rotator = compress_log
+    else:
+        handler = logging.FileHandler(log_file)
+    handler.addFilter(clock_timestamps)
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
         handlers=[
-            logging.FileHandler(log_file),
+            handler,
         ]
     )
     return logging.getLogger(__name__)
 
+class LogRotator(logging.handlers.RotatingFileHandler):
+    """Size-based rotation that counts what it writes
+    
+    The stock shouldRollover() stats the log twice and formats every
+    record a second time, doubling the cost of each log call.
+    """
+    
+    def __init__(self, filename, maxBytes, backupCount):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        self.written = os.path.getsize(filename) if os.path.exists(filename) else 0
+    
+    def format(self, record):
+        message = super().format(record)
+        # Bytes, not characters: the log is full of multi-byte emoji
+        self.written += len(message.encode(self.encoding or 'utf-8')) + len(self.terminator)
+        return message
+    
+    def shouldRollover(self, record):
+        return self.written >= self.maxBytes
+    
+    def doRollover(self):
+        super().doRollover()
+        self.written = 0
+
+def compress_log(source, dest):
+    """Rotate the log into a gzip archive (RotatingFileHandler.rotator)"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def tail_lines(path, count, block_size=8192):
+    """Return the last count lines of a file, reading only blocks from its end"""
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b''
+        while position > 0 and data.count(b'\n') <= count:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return data.decode(errors='replace').splitlines()[-count:]
+
+# inotify(7) event masks
+IN_MODIFY = 0x2
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+INOTIFY_EVENT = struct.Struct('iIII')
+
+def follow_log(path):
+    """Print lines appended to the log as they arrive, across rotations
+    
+    Watches the log's directory with inotify, so a rotated-in file is
+    picked up; falls back to polling once a second without inotify.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    notify_fd = -1
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        notify_fd = libc.inotify_init1(os.O_CLOEXEC)
+        if notify_fd >= 0 and libc.inotify_add_watch(
+                notify_fd, directory.encode(), IN_MODIFY | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(notify_fd)
+            notify_fd = -1
+    except (OSError, AttributeError):
+        notify_fd = -1
+    
+    f = open(path, 'r', errors='replace') if os.path.exists(path) else None
+    if f is not None:
+        f.seek(0, os.SEEK_END)
+    try:
+        while True:
+            reopen = False
+            if notify_fd >= 0:
+                data = os.read(notify_fd, 65536)
+                changed = False
+                offset = 0
+                while offset < len(data):
+                    _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                    offset += INOTIFY_EVENT.size
+                    event_name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                    offset += length
+                    if event_name == name:
+                        changed = True
+                        reopen = reopen or bool(mask & (IN_CREATE | IN_MOVED_TO))
+                if not changed:
+                    continue
+            else:
+                time.sleep(1)
+                try:
+                    reopen = f is None or os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+                except OSError:
+                    continue
+            
+            if f is not None:
+                sys.stdout.write(f.read())
+            if reopen and os.path.exists(path):
+                if f is not None:
+                    f.close()
+                f = open(path, 'r', errors='replace')
+                sys.stdout.write(f.read())
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if f is not None:
+            f.close()
+        if notify_fd >= 0:
+            os.close(notify_fd)
+
+def clock_timestamps(record):
+    """Stamp log records with the session clock (virtual when simulating)"""
+    record.created = clock.time()
+    record.msecs = (record.created % 1) * 1000
+    return True
+
+class SystemClock:
+    """The real time source"""
+    
+    def time(self):
+        return time.time()
+    
+    def monotonic(self):
+        return time.monotonic()
+    
+    def now(self):
+        return datetime.now()
+    
+    def sleep_blocking(self, seconds):
+        """Sleep in a worker thread (or before/after the event loop)"""
+        time.sleep(seconds)
+    
+    def run(self, func, *args):
+        """Run a blocking step; called in the worker thread"""
+        return func(*args)
+    
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+class VirtualClock(SystemClock):
+    """Simulated time that jumps ahead whenever everything is waiting
+    
+    The event loop's timers and worker-thread sleeps are kept on one
+    virtual timeline. When no fd is ready and no worker thread is doing
+    real work, the clock advances straight to the earliest wake-up, so a
+    session of hours runs in seconds with the same ordering of events.
+    """
+    
+    def __init__(self):
+        self.start = time.time()
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+        self.waiters = []   # heap of (wake time, seq, threading.Event)
+        self.sequence = 0
+        self.busy = 0   # worker threads running real (non-sleeping) code
+        self.loop = None
+    
+    def time(self):
+        return self.start + self.elapsed
+    
+    def monotonic(self):
+        return self.elapsed
+    
+    def now(self):
+        return datetime.fromtimestamp(self.time())
+    
+    def sleep_blocking(self, seconds):
+        if self.loop is None:
+            # Nothing runs concurrently outside the event loop
+            with self.lock:
+                self.elapsed += max(0.0, seconds)
+            return
+        wake = threading.Event()
+        with self.lock:
+            self.busy -= 1
+            self.sequence += 1
+            heapq.heappush(self.waiters, (self.elapsed + max(0.0, seconds), self.sequence, wake))
+        # Let the loop see the new waiter if it is blocked in select()
+        self.loop.call_soon_threadsafe(lambda: None)
+        wake.wait()
+    
+    def run(self, func, *args):
+        with self.lock:
+            self.busy += 1
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.busy -= 1
+    
+    def advance(self, timeout):
+        """Called from select(): jump to the next wake-up, or return False to block"""
+        with self.lock:
+            if self.busy:
+                return False
+            target = None if timeout is None else self.elapsed + timeout
+            if self.waiters and (target is None or self.waiters[0][0] < target):
+                target = self.waiters[0][0]
+            if target is None:
+                return False
+            self.elapsed = max(self.elapsed, target)
+            while self.waiters and self.waiters[0][0] <= self.elapsed:
+                _, _, wake = heapq.heappop(self.waiters)
+                self.busy += 1
+                wake.set()
+            return True
+    
+    def run_async(self, coro):
+        self.loop = VirtualTimeLoop(self)
+        try:
+            return self.loop.run_until_complete(coro)
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+            self.loop = None
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    """Selector that advances a VirtualClock instead of sleeping"""
+    
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+    
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or (timeout is not None and timeout <= 0):
+            return ready
+        if self.clock.advance(timeout):
+            return []
+        # A worker thread is running (or nothing is scheduled): wait for real
+        return super().select(None)
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop whose timers run on a VirtualClock"""
+    
+    def __init__(self, clock):
+        super().__init__(VirtualTimeSelector(clock))
+        self.clock = clock
+    
+    def time(self):
+        return self.clock.monotonic()
+
+# Time source for waits, timings and log timestamps (see simulate)
+clock = SystemClock()
+
+def apt_options():
+    """Extra apt -o options for the current mode"""
+    if not config['mirror_mode']:
+        return []
+    return [
+        '-o', f"Dir::Etc::SourceList={mirror_dir}/sources.list",
+        '-o', 'Dir::Etc::SourceParts=-',
+        '-o', f"Dir::State::Lists={mirror_dir}/lists",
+    ]
+
+def apt_command(tool, *args):
+    """Build an apt/apt-cache command line honouring the current mode"""
+    options = apt_options()
+    if tool == 'apt':
+        # The apt binary deletes fetched debs after installing; the archive cache needs them
+        options += ['-o', 'APT::Keep-Downloaded-Packages=true']
+    return [tool] + options + list(args)
+
+def usage_from_rusage(ru):
+    """Pick the fields we account from a struct rusage"""
+    return {
+        'user': ru.ru_utime,
+        'sys': ru.ru_stime,
+        'maxrss_kb': ru.ru_maxrss,
+        'inblock': ru.ru_inblock,
+        'oublock': ru.ru_oublock,
+        'nvcsw': ru.ru_nvcsw,
+        'nivcsw': ru.ru_nivcsw,
+    }
+
+def add_usage(target, usage, share=1.0):
+    """Accumulate usage into target; max RSS is a peak, everything else a sum"""
+    for field, value in usage.items():
+        if field == 'maxrss_kb':
+            target[field] = max(target.get(field, 0), value)
+        else:
+            target[field] = target.get(field, 0) + value * share
+
+def account_child(usage, batch=None, packages=()):
+    """Charge a child's usage to the session, its batch and its packages
+    
+    A transaction's cost is split evenly across the packages it handled.
+    """
+    with usage_lock:
+        add_usage(usage_total, usage)
+        add_usage(usage_by_batch.setdefault(current_batch if batch is None else batch, {}), usage)
+        for package in packages:
+            add_usage(usage_by_package.setdefault(package, {}), usage, 1.0 / len(packages))
+
+def child_exited(process):
+    """True once the child has exited, without reaping it"""
+    return os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+
+def wait_child(process, timeout=None, packages=()):
+    """Reap a Popen child with wait4() and account its resource usage
+    
+    Raises subprocess.TimeoutExpired (after killing the child) on timeout.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    
+    timed_out = False
+    try:
+        while True:
+            pid, status, ru = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                process.kill()
+                _, status, ru = os.wait4(process.pid, 0)
+                timed_out = True
+                break
+            if pidfd is not None:
+                select.select([pidfd], [], [], remaining)
+            else:
+                time.sleep(0.05 if remaining is None else min(0.05, remaining))
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+    
+    process.returncode = os.waitstatus_to_exitcode(status)
+    account_child(usage_from_rusage(ru), packages=packages)
+    if timed_out:
+        raise subprocess.TimeoutExpired(process.args, timeout)
+    return process.returncode
+
+def run_command(cmd, timeout, packages=()):
+    """Like subprocess.run(capture_output=True, text=True), with usage accounting
+    
+    Output goes to temporary files so the child can be reaped with wait4().
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=out, stderr=err)
+        wait_child(process, timeout, packages)
+        out.seek(0)
+        err.seek(0)
+        return subprocess.CompletedProcess(
+            cmd,
+            process.returncode,
+            out.read().decode(errors='replace'),
+            err.read().decode(errors='replace')
+        )
+
+def children_usage_snapshot():
+    """Usage of all reaped children plus what wait_child() has attributed"""
+    with usage_lock:
+        return usage_from_rusage(resource.getrusage(resource.RUSAGE_CHILDREN)), dict(usage_total)
+
+def account_unattributed(snapshot, batch, packages):
+    """Charge children reaped outside wait_child() since snapshot (asyncio ones)"""
+    before_children, before_attributed = snapshot
+    after_children, after_attributed = children_usage_snapshot()
+    usage = {}
+    for field, value in after_children.items():
+        if field == 'maxrss_kb':
+            # Peak RSS cannot be separated; only report a new high
+            usage[field] = value if value > before_children[field] else 0
+        else:
+            attributed = after_attributed.get(field, 0) - before_attributed.get(field, 0)
+            usage[field] = max(0, value - before_children[field] - attributed)
+    account_child(usage, batch, packages)
+
+def format_usage(usage):
+    """One-line summary of accounted usage"""
+    return (
+        f"user {usage.get('user', 0):.1f}s, sys {usage.get('sys', 0):.1f}s, "
+        f"max RSS {usage.get('maxrss_kb', 0) // 1024} MB, "
+        f"blocks in/out {int(usage.get('inblock', 0))}/{int(usage.get('oublock', 0))}, "
+        f"ctx switches {int(usage.get('nvcsw', 0))}/{int(usage.get('nivcsw', 0))}"
+    )
+
+def log_usage_summary(logger):
+    """Log session-wide child usage and the most expensive packages"""
+    with usage_lock:
+        total = dict(usage_total)
+        by_package = sorted(
+            usage_by_package.items(),
+            key=lambda item: item[1].get('user', 0) + item[1].get('sys', 0),
+            reverse=True
+        )[:10]
+    logger.info(f"Child resource usage: {format_usage(total)}")
+    for package, usage in by_package:
+        logger.info(f"  {package}: {format_usage(usage)}")
+
+def report_progress(phase, percent, message):
+    """Record apt progress, logging phase changes and every 25% step
+    
+    Time since the previous event is charged to the previous phase in
+    apt_phase_seconds. 'resolve' marks the start of a transaction and
+    'idle' its end; neither is logged.
+    """
+    now = clock.monotonic()
+    previous_phase = apt_progress['phase']
+    if previous_phase != 'idle':
+        apt_phase_seconds[previous_phase] = (
+            apt_phase_seconds.get(previous_phase, 0.0) + now - apt_progress['since']
+        )
+    previous_step = int(apt_progress['percent'] // 25)
+    apt_progress.update(phase=phase, percent=percent, message=message, since=now)
+    if phase in ('idle', 'resolve'):
+        return
+    if phase != previous_phase or int(percent // 25) != previous_step:
+        logging.getLogger(__name__).info(f"  [{phase} {percent:.0f}%] {message}")
+
+def record_timing(phase, seconds, batch=None, **fields):
+    """Append one phase timing as a JSON line next to the log"""
+    record = {
+        'time': clock.now().isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        'batch': current_batch if batch is None else batch,
+        'phase': phase,
+        'seconds': round(seconds, 3),
+    }
+    record.update(fields)
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    with timings_lock:
+        try:
+            # Explicit mode: the daemon's umask 0 would leave it world-writable
+            fd = os.open(timings_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+            with open(fd, 'a') as f:
+                f.write(line)
+        except OSError:
+            pass
+    observe_phase(phase, seconds)
+
+def metrics_path():
+    """Where to write the Prometheus textfile"""
+    if config['metrics_file']:
+        return config['metrics_file']
+    if os.path.isdir(textfile_dir):
+        return os.path.join(textfile_dir, 'background_installer.prom')
+    return "/tmp/background_batch_installer.prom"
+
+def observe_phase(phase, seconds):
+    """Add a phase duration to its histogram and refresh the metrics file"""
+    with metrics_lock:
+        histogram = phase_histograms.setdefault(
+            phase, {'buckets': [0] * len(PHASE_BUCKETS), 'sum': 0.0, 'count': 0}
+        )
+        for i, bound in enumerate(PHASE_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+    write_metrics()
+
+def count_result(operation, ok):
+    """Count a batch install/removal outcome"""
+    key = (operation, 'success' if ok else 'failure')
+    with metrics_lock:
+        result_counts[key] = result_counts.get(key, 0) + 1
+    write_metrics()
+
+def set_state(state):
+    """Record what the daemon is doing and refresh the metrics file"""
+    session['state'] = state
+    write_metrics()
+
+def write_metrics():
+    """Atomically rewrite the Prometheus textfile from the session counters"""
+    prefix = 'background_installer'
+    lines = [
+        f"# HELP {prefix}_batches_processed_total Batches completed this session.",
+        f"# TYPE {prefix}_batches_processed_total counter",
+        f"{prefix}_batches_processed_total {session['batches']}",
+        f"# HELP {prefix}_apps_processed Apps installed and removed this session.",
+        f"# TYPE {prefix}_apps_processed gauge",
+        f"{prefix}_apps_processed {session['processed_apps']}",
+        f"# HELP {prefix}_apps_total Apps planned for this session.",
+        f"# TYPE {prefix}_apps_total gauge",
+        f"{prefix}_apps_total {session['total_apps']}",
+        f"# HELP {prefix}_download_bytes_total Catalogue deb bytes not found in the archive cache.",
+        f"# TYPE {prefix}_download_bytes_total counter",
+        f"{prefix}_download_bytes_total {archive_stats['miss_bytes']}",
+        f"# HELP {prefix}_dpkg_lock_waits_total apt runs that queued behind another dpkg lock holder.",
+        f"# TYPE {prefix}_dpkg_lock_waits_total counter",
+        f"{prefix}_dpkg_lock_waits_total {lock_stats['waits']}",
+        f"# HELP {prefix}_dpkg_lock_wait_seconds_total Seconds spent queued for the dpkg lock.",
+        f"# TYPE {prefix}_dpkg_lock_wait_seconds_total counter",
+        f"{prefix}_dpkg_lock_wait_seconds_total {lock_stats['seconds']:.3f}",
+        f"# HELP {prefix}_state Current daemon state.",
+        f"# TYPE {prefix}_state gauge",
+    ]
+    for state in SESSION_STATES:
+        lines.append(f'{prefix}_state{{state="{state}"}} {int(session["state"] == state)}')
+    lines.append(f"# HELP {prefix}_throttle_level Host load level the throttle last saw.")
+    lines.append(f"# TYPE {prefix}_throttle_level gauge")
+    for level in THROTTLE_LEVELS:
+        lines.append(f'{prefix}_throttle_level{{level="{level}"}} {int(session["throttle"] == level)}')
+    
+    with metrics_lock:
+        lines.append(f"# HELP {prefix}_batch_operations_total Batch installs and removals by result.")
+        lines.append(f"# TYPE {prefix}_batch_operations_total counter")
+        for operation in ('install', 'remove'):
+            for result in ('success', 'failure'):
+                count = result_counts.get((operation, result), 0)
+                lines.append(f'{prefix}_batch_operations_total{{operation="{operation}",result="{result}"}} {count}')
+        
+        lines.append(f"# HELP {prefix}_phase_duration_seconds Duration of batch phases.")
+        lines.append(f"# TYPE {prefix}_phase_duration_seconds histogram")
+        for phase, histogram in sorted(phase_histograms.items()):
+            for bound, count in zip(PHASE_BUCKETS, histogram['buckets']):
+                lines.append(f'{prefix}_phase_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+            lines.append(f'{prefix}_phase_duration_seconds_bucket{{phase="{phase}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{prefix}_phase_duration_seconds_sum{{phase="{phase}"}} {histogram["sum"]:.3f}')
+            lines.append(f'{prefix}_phase_duration_seconds_count{{phase="{phase}"}} {histogram["count"]}')
+        
+        # Write next to the target and rename so the collector never sees a
+        # partial file; explicit mode, the daemon's umask 0 would leave it world-writable
+        path = metrics_path()
+        try:
+            if os.path.lexists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            with open(fd, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+def journal(event, **fields):
+    """Append a session/batch state transition to the journal and fsync it
+    
+    Events: session (total_apps), selected (batch, apps, size, preinstalled),
+    installed, holding (until, epoch seconds) and removed (processed_apps,
+    leftover). A batch is open from selected until removed.
+    """
+    record = {'event': event, 'time': round(clock.time(), 3)}
+    record.update(fields)
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    try:
+        directory = os.path.dirname(journal_file)
+        created = not os.path.exists(journal_file)
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if created:
+            # Make the new directory entry itself durable
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+    except OSError as e:
+        logging.getLogger(__name__).warning(f"⚠ Could not write session journal: {e}")
+
+def read_journal():
+    """Replay the journal into the state of an unfinished session, or None
+    
+    Returns {total_apps, processed_apps, batches, open: [batch records]}.
+    A batch whose removal left packages installed stays open with just
+    those packages. A torn last line from a crash mid-write is ignored.
+    """
+    try:
+        with open(journal_file, 'r') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    
+    state = None
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        event = record.get('event')
+        if event == 'session':
+            state = {'total_apps': record['total_apps'], 'processed_apps': 0,
+                     'batches': 0, 'open': {}}
+        elif state is None:
+            continue
+        elif event == 'selected':
+            state['open'][record['batch']] = {
+                'batch': record['batch'], 'apps': record['apps'],
+                'size': record['size'], 'state': 'selected',
+                'preinstalled': record.get('preinstalled', []),
+            }
+        elif event in ('installed', 'holding') and record['batch'] in state['open']:
+            state['open'][record['batch']].update(state=event, until=record.get('until'))
+        elif event == 'removed':
+            state['open'].pop(record['batch'], None)
+            state['batches'] = max(state['batches'], record['batch'])
+            state['processed_apps'] = record['processed_apps']
+            # Packages a failed removal left installed stay open, already counted
+            if record.get('leftover'):
+                state['open'][record['batch']] = {
+                    'batch': record['batch'], 'apps': record['leftover'],
+                    'size': 0, 'state': 'leftover', 'preinstalled': [],
+                }
+    
+    if state is not None:
+        state['open'] = [state['open'][batch] for batch in sorted(state['open'])]
+    return state
+
+def clear_journal():
+    """Forget a finished session"""
+    try:
+        os.remove(journal_file)
+    except OSError:
+        pass
+
+@contextmanager
+def timed_phase(phase, batch=None, **fields):
+    """Time a block and record it; the yielded dict can carry extra fields
+    
+    Any apt time spent inside the block is broken down by apt phase.
+    """
+    start = clock.monotonic()
+    apt_before = dict(apt_phase_seconds)
+    try:
+        yield fields
+    finally:
+        apt_time = {
+            name: round(seconds - apt_before.get(name, 0.0), 3)
+            for name, seconds in apt_phase_seconds.items()
+            if seconds - apt_before.get(name, 0.0) > 0
+        }
+        if apt_time:
+            fields['apt'] = apt_time
+        record_timing(phase, clock.monotonic() - start, batch, **fields)
+
+def batch_bytes(apps_list):
+    """Download size of a batch's own debs, from the package index"""
+    index = load_package_index() or {}
+    return sum(index.get(app, {}).get('size', 0) for app in apps_list)
+
+def parse_status_line(line):
+    """Parse an APT::Status-Fd line into (phase, percent, message), or None"""
+    parts = line.split(':', 3)
+    if len(parts) != 4:
+        return None
+    kind, _, percent, message = parts
+    try:
+        percent = float(percent)
+    except ValueError:
+        return None
+    
+    if kind == 'dlstatus':
+        return 'download', percent, message
+    if kind == 'pmerror':
+        return 'error', percent, message
+    if kind != 'pmstatus':
+        return None
+    
+    lowered = message.lower()
+    if lowered.startswith(('preparing to unpack', 'unpacking', 'unpacked', 'installing')):
+        phase = 'unpack'
+    elif lowered.startswith(('preparing to configure', 'configuring', 'installed')):
+        phase = 'configure'
+    elif lowered.startswith(('preparing for removal', 'removing', 'removed',
+                             'preparing to completely remove', 'completely removing',
+                             'completely removed')):
+        phase = 'remove'
+    else:
+        phase = 'dpkg'
+    return phase, percent, message
+
+def dpkg_lock_free():
+    """Probe the dpkg frontend lock with F_GETLK; None if it cannot be probed
+    
+    F_GETLK only asks who would conflict, so the probe never holds the lock
+    itself and cannot make a concurrent apt fail.
+    """
+    try:
+        fd = os.open(dpkg_lock_file, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        # struct flock: l_type, l_whence, l_start, l_len, l_pid
+        request = struct.pack('hhqqi4x', fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+        lock_type = struct.unpack('hhqqi4x', fcntl.fcntl(fd, fcntl.F_GETLK, request))[0]
+        return lock_type == fcntl.F_UNLCK
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+def dpkg_lock_holder():
+    """Describe who holds the dpkg frontend lock, e.g. 'unattended-upgr (812)'"""
+    try:
+        inode = str(os.stat(dpkg_lock_file).st_ino)
+        with open('/proc/locks', 'r') as f:
+            for line in f:
+                # 1: POSIX  ADVISORY  WRITE 812 08:01:1835027 0 EOF
+                fields = line.split()
+                if '->' in fields or len(fields) < 6 or fields[5].rsplit(':', 1)[-1] != inode:
+                    continue
+                with open(f"/proc/{fields[4]}/comm", 'r') as comm:
+                    return f"{comm.read().strip()} ({fields[4]})"
+    except OSError:
+        pass
+    return "another process"
+
+def wait_for_dpkg_lock(cmd):
+    """Wait with bounded backoff while another process holds the dpkg lock
+    
+    Returns the seconds queued. Raises subprocess.TimeoutExpired after
+    lock_wait_timeout or on shutdown, so callers treat it as a timed-out
+    apt run rather than a failed transaction worth bisecting.
+    """
+    if dpkg_lock_free() is not False:
+        return 0.0
+    logger = logging.getLogger(__name__)
+    logger.info(f"dpkg lock held by {dpkg_lock_holder()}, waiting for it...")
+    
+    start = clock.monotonic()
+    delay = 1.0
+    acquired = False
+    while not acquired:
+        waited = clock.monotonic() - start
+        if shutdown_flag or waited >= config['lock_wait_timeout']:
+            break
+        clock.sleep_blocking(min(delay, config['lock_wait_timeout'] - waited))
+        delay = min(delay * 2, 30.0)
+        acquired = dpkg_lock_free() is not False
+    
+    waited = clock.monotonic() - start
+    lock_stats['waits'] += 1
+    lock_stats['seconds'] += waited
+    record_timing('lock_wait', waited)
+    if not acquired:
+        logger.warning(f"⚠ dpkg lock still held by {dpkg_lock_holder()} after {waited:.0f}s, not starting apt")
+        raise subprocess.TimeoutExpired(cmd, waited)
+    logger.info(f"✓ dpkg lock free after {waited:.0f}s")
+    return waited
+
+def run_apt(cmd, timeout, packages=(), dpkg_lock=True):
+    """Run an apt command once the dpkg lock is free (see stream_apt)
+    
+    dpkg_lock=False is for commands that do not take it, like apt update.
+    If another process grabs a lock between the probe and apt starting (or
+    holds one the probe cannot see, like the archives lock), apt fails fast
+    with "Could not get lock" and we back off and queue again.
+    """
+    for attempt in range(3):
+        if dpkg_lock:
+            wait_for_dpkg_lock(cmd)
+        ok, error = stream_apt(cmd, timeout, packages)
+        if ok or not dpkg_lock or 'Could not get lock' not in error or attempt == 2 or shutdown_flag:
+            break
+        delay = 5 * 2 ** attempt
+        logging.getLogger(__name__).info(f"apt could not get a lock, retrying in {delay}s...")
+        clock.sleep_blocking(delay)
+    return ok, error
+
+def stream_apt(cmd, timeout, packages=()):
+    """Run an apt command, streaming its output and Status-Fd progress
+    
+    Only the last OUTPUT_TAIL_LINES lines of output are kept, so memory stays
+    bounded however much apt prints. Returns (ok, error_text) and raises
+    subprocess.TimeoutExpired like subprocess.run().
+    """
+    status_read, status_write = os.pipe()
+    argv = cmd[:1] + ['-o', f"APT::Status-Fd={status_write}"] + cmd[1:]
+    try:
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            pass_fds=(status_write,)
+        )
+    except Exception:
+        os.close(status_read)
+        raise
+    finally:
+        os.close(status_write)
+    
+    report_progress('resolve', 0.0, '')
+    output_fd = process.stdout.fileno()
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    errors = deque(maxlen=OUTPUT_TAIL_LINES)
+    pending = {output_fd: b'', status_read: b''}
+    deadline = time.monotonic() + timeout
+    reaped = False
+    
+    def handle(fd, raw):
+        line = raw.decode(errors='replace').rstrip()
+        if fd == status_read:
+            event = parse_status_line(line)
+            if event is None:
+                return
+            if event[0] == 'error':
+                errors.append(event[2])
+            else:
+                report_progress(*event)
+        elif line:
+            tail.append(line)
+            if line.startswith(('E:', 'dpkg:', 'Errors were encountered')):
+                errors.append(line)
+    
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(output_fd, selectors.EVENT_READ)
+            selector.register(status_read, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Raises TimeoutExpired unless apt already exited and was just reaped
+                    wait_child(process, 0, packages)
+                    reaped = True
+                    break
+                
+                events = selector.select(min(remaining, 1))
+                # Services started by maintainer scripts can hold the pipe open
+                if not events and child_exited(process):
+                    break
+                for key, _ in events:
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fd)
+                        if pending[key.fd]:
+                            handle(key.fd, pending[key.fd])
+                        continue
+                    *lines, pending[key.fd] = (pending[key.fd] + data).split(b'\n')
+                    for raw in lines:
+                        handle(key.fd, raw)
+        if not reaped:
+            wait_child(process, max(0, deadline - time.monotonic()), packages)
+    finally:
+        process.stdout.close()
+        os.close(status_read)
+        report_progress('idle', 0.0, '')
+    
+    return process.returncode == 0, '\n'.join(errors or tail)
+
+def enable_mirror_mode(logger):
+    """Point every apt invocation at the local flat repository"""
+    global apt_lists_dir
+    if not os.path.exists(os.path.join(mirror_dir, 'Packages')):
+        logger.error(f"No local mirror at {mirror_dir}, run the 'mirror' command first")
+        return False
+    
+    os.makedirs(os.path.join(mirror_dir, 'lists', 'partial'), exist_ok=True)
+    with open(os.path.join(mirror_dir, 'sources.list'), 'w') as f:
+        f.write(f"deb [trusted=yes] file:{mirror_dir} ./\n")
+    
+    apt_lists_dir = os.path.join(mirror_dir, 'lists')
+    if apt is not None:
+        for option in apt_options()[1::2]:
+            name, _, value = option.partition('=')
+            apt_pkg.config.set(name, value)
+    logger.info(f"Mirror mode: installing from file:{mirror_dir}")
+    return True
+
+def build_mirror(fetch_missing=False):
+    """Build a flat apt repository in mirror_dir from the local archive cache
+    
+    With fetch_missing, catalogue packages without a cached .deb are first
+    downloaded (with the dependencies this host does not already have).
+    """
+    os.makedirs(mirror_dir, exist_ok=True)
+    index = load_package_index() or {}
+    
+    if fetch_missing:
+        cached = {deb[0] for deb in scan_archive_cache()}
+        missing = [app for app in sorted(index) if app not in cached]
+        print(f"Downloading {len(missing)} uncached catalogue packages...")
+        for app in missing:
+            run_command(
+                apt_command('apt', 'install', '-y', '--download-only', '--no-install-recommends', app),
+                timeout=600
+            )
+    
+    # Reuse stanzas for debs that are already indexed
+    packages_file = os.path.join(mirror_dir, 'Packages')
+    known = {}
+    if os.path.exists(packages_file):
+        with open(packages_file, 'r') as f:
+            for stanza in f.read().split('\n\n'):
+                for line in stanza.splitlines():
+                    if line.startswith('Filename: '):
+                        known[line[len('Filename: '):]] = stanza.strip()
+    
+    stanzas = []
+    for _, _, path, size, _ in scan_archive_cache():
+        name = os.path.basename(path)
+        target = os.path.join(mirror_dir, name)
+        if not os.path.exists(target) or os.path.getsize(target) != size:
+            try:
+                os.link(path, target)
+            except OSError:
+                shutil.copy2(path, target)
+        
+        filename = f"./{name}"
+        if filename in known:
+            stanzas.append(known[filename])
+            continue
+        
+        control = run_command(['dpkg-deb', '-f', target], timeout=30)
+        if control.returncode != 0:
+            print(f"  ✗ Skipping unreadable {name}")
+            continue
+        
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        with open(target, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+                sha256.update(block)
+        stanzas.append(
+            control.stdout.strip() + f"\nFilename: {filename}\nSize: {size}"
+            f"\nMD5sum: {md5.hexdigest()}\nSHA256: {sha256.hexdigest()}"
+        )
+    
+    content = '\n\n'.join(stanzas) + '\n'
+    with open(packages_file + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(packages_file + '.tmp', packages_file)
+    
+    data = content.encode()
+    with open(os.path.join(mirror_dir, 'Release'), 'w') as f:
+        f.write(f"Date: {time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime())}\n")
+        f.write(f"MD5Sum:\n {hashlib.md5(data).hexdigest()} {len(data)} Packages\n")
+        f.write(f"SHA256:\n {hashlib.sha256(data).hexdigest()} {len(data)} Packages\n")
+    
+    print(f"✓ Local mirror built: {len(stanzas)} packages in {mirror_dir}")
+    return len(stanzas)
+
+if apt is not None:
+    class AcquireProgressReporter(apt.progress.base.AcquireProgress):
+        """Feed libapt download progress into report_progress()"""
+        
+        def pulse(self, owner):
+            if self.total_bytes:
+                percent = self.current_bytes * 100.0 / self.total_bytes
+                report_progress('download', percent,
+                                f"{self.current_items}/{self.total_items} files")
+            return True
+    
+    class InstallProgressReporter(apt.progress.base.InstallProgress):
+        """Feed dpkg progress from libapt into report_progress()"""
+        
+        def status_change(self, pkg, percent, status):
+            event = parse_status_line(f"pmstatus:{pkg}:{percent}:{status}")
+            if event is not None:
+                report_progress(*event)
+
+class LibAptBackend:
+    """Package operations on one apt.Cache kept open for the whole session"""
+    
+    def __init__(self):
+        os.environ.setdefault('DEBIAN_FRONTEND', 'noninteractive')
+        self.cache = apt.Cache()
+    
+    def update(self):
+        """Refresh the package lists and reload the cache"""
+        self.cache.update()
+        self.cache.open(None)
+    
+    def package_records(self, names):
+        """Return candidate metadata for the names the cache knows about"""
+        packages = {}
+        for name in names:
+            if name not in self.cache:
+                continue
+            candidate = self.cache[name].candidate
+            if candidate is None:
+                continue
+            packages[name] = {
+                'version': candidate.version,
+                'size': candidate.size,
+                'installed_size': candidate.installed_size,
+            }
+        return packages
+    
+    def install_state(self, names):
+        """Return {name: 'installed' | 'not-installed'}"""
+        states = {}
+        for name in names:
+            installed = name in self.cache and self.cache[name].is_installed
+            states[name] = 'installed' if installed else 'not-installed'
+        return states
+    
+    def commit(self, install=(), remove=(), install_recommends=False):
+        """Mark installs/purges in memory and commit them as one transaction"""
+        apt_pkg.config.set('APT::Install-Recommends', 'true' if install_recommends else 'false')
+        report_progress('resolve', 0.0, '')
+        # libapt forks and reaps dpkg itself, so account its usage by difference
+        usage_before = children_usage_snapshot()
+        try:
+            with self.cache.actiongroup():
+                for name in remove:
+                    self.cache[name].mark_delete(purge=True)
+                for name in install:
+                    self.cache[name].mark_install()
+            if self.cache.broken_count:
+                raise SystemError(f"{self.cache.broken_count} broken packages after marking")
+            wait_for_dpkg_lock(['libapt', 'commit'])
+            self.cache.commit(AcquireProgressReporter(), InstallProgressReporter())
+            return True, ''
+        except subprocess.TimeoutExpired:
+            raise
+        except Exception as e:
+            return False, str(e)
+        finally:
+            account_unattributed(usage_before, None, list(install) + list(remove))
+            report_progress('idle', 0.0, '')
+            self.cache.open(None)
+    
+    def autoremove(self):
+        """Purge packages that are no longer needed"""
+        with self.cache.actiongroup():
+            for pkg in self.cache:
+                if pkg.is_auto_removable:
+                    pkg.mark_delete(purge=True)
+        return self.commit()
+
+class FakePackageBackend:
+    """Simulated apt/dpkg with configurable latency, failure rate and sizes
+    
+    Implements the LibAptBackend interface without touching the system.
+    Every operation sleeps on the session clock, so under a VirtualClock a
+    whole session runs in seconds while producing the usual log, timings
+    and metrics.
+    """
+    
+    def __init__(self, packages, seed=None, install_latency=20.0, remove_latency=6.0,
+                 fail_rate=0.03, missing_rate=0.05, max_size_mb=80, bandwidth_mb=8.0):
+        self.rng = random.Random(seed)
+        self.install_latency = install_latency
+        self.remove_latency = remove_latency
+        self.bandwidth = bandwidth_mb * 1024 * 1024
+        self.records = {}
+        self.broken = set()
+        for name in sorted(set(packages)):
+            if self.rng.random() < missing_rate:
+                continue
+            size = int(self.rng.lognormvariate(0, 1.5) * max_size_mb * 1024 * 1024 / 20)
+            size = max(16 * 1024, min(size, max_size_mb * 1024 * 1024))
+            self.records[name] = {
+                'version': '1.0-0sim1',
+                'size': size,
+                'installed_size': size * self.rng.randint(2, 5),
+            }
+            if self.rng.random() < fail_rate:
+                self.broken.add(name)
+        self.installed = set()
+        self.downloaded = set()
+    
+    def latency(self, base):
+        """Jittered duration of one package operation"""
+        return base * self.rng.uniform(0.5, 1.5)
+    
+    def update(self):
+        """Pretend to refresh the package lists"""
+        clock.sleep_blocking(self.latency(30.0))
+    
+    def package_records(self, names):
+        """Return candidate metadata for the simulated packages"""
+        return {name: dict(self.records[name]) for name in names if name in self.records}
+    
+    def install_state(self, names):
+        """Return {name: 'installed' | 'not-installed'}"""
+        return {name: 'installed' if name in self.installed else 'not-installed' for name in names}
+    
+    def fetch(self, names):
+        """Simulate downloading the debs not fetched yet"""
+        missing = [name for name in names if name not in self.downloaded]
+        total = sum(self.records[name]['size'] for name in missing)
+        done = 0
+        for name in missing:
+            clock.sleep_blocking(self.records[name]['size'] / self.bandwidth)
+            done += self.records[name]['size']
+            self.downloaded.add(name)
+            report_progress('download', done * 100.0 / total, name)
+    
+    async def download(self, names):
+        """Simulated --download-only run for prepare_batch"""
+        names = [name for name in names if name in self.records and name not in self.downloaded]
+        await asyncio.sleep(sum(self.records[name]['size'] for name in names) / self.bandwidth)
+        self.downloaded.update(names)
+    
+    def commit(self, install=(), remove=(), install_recommends=False):
+        """Apply purges and installs as one transaction that fails as a whole"""
+        report_progress('resolve', 0.0, '')
+        try:
+            clock.sleep_blocking(self.latency(2.0))
+            for name in install:
+                if name not in self.records:
+                    return False, f"E: Unable to locate package {name}"
+            self.fetch(install)
+            for i, name in enumerate(remove):
+                report_progress('remove', i * 100.0 / len(remove), f"Removing {name}")
+                clock.sleep_blocking(self.latency(self.remove_latency))
+            # Like dpkg: unpack everything, then configure everything
+            for i, name in enumerate(install):
+                report_progress('unpack', i * 100.0 / len(install), f"Unpacking {name}")
+                clock.sleep_blocking(self.latency(self.install_latency / 2))
+            for i, name in enumerate(install):
+                if name in self.broken:
+                    return False, (f"dpkg: error processing package {name} (--configure):\n"
+                                   f" installed {name} package post-installation script subprocess "
+                                   f"returned error exit status 1")
+                report_progress('configure', i * 100.0 / len(install), f"Configuring {name}")
+                clock.sleep_blocking(self.latency(self.install_latency / 2))
+            self.installed.difference_update(remove)
+            self.installed.update(install)
+            return True, ''
+        finally:
+            report_progress('idle', 0.0, '')
+    
+    def autoremove(self):
+        """Pretend to purge packages that are no longer needed"""
+        clock.sleep_blocking(self.latency(5.0))
+        return True, ''
+
+def init_apt_backend(logger):
+    """Open the libapt backend if enabled and python-apt is available
+    
+    libapt runs update and commit in-process, where the apt timeouts cannot
+    be enforced, so the subprocess path stays the default.
+    """
+    global apt_backend
+    if apt_backend is not None:
+        logger.info(f"Using {type(apt_backend).__name__} backend")
+        return apt_backend
+    if not config['libapt']:
+        logger.info("Using apt/dpkg subprocesses")
+        return None
+    if apt is None:
+        logger.info("python-apt not available, using apt/dpkg subprocesses")
+        return None
+    try:
+        apt_backend = LibAptBackend()
+        logger.info("Using in-process libapt backend")
+    except Exception as e:
+        apt_backend = None
+        logger.warning(f"Could not open apt cache ({e}), using apt/dpkg subprocesses")
+    return apt_backend
+
+def update_stamp_path():
+    """Stamp recording the last successful update of the lists in use"""
+    if config['mirror_mode']:
+        return os.path.join(mirror_dir, 'updated')
+    return update_stamp_file
+
+def touch_update_stamp():
+    """Record a successful apt update
+    
+    Created 0644 despite the daemon's umask 0: anyone able to touch the
+    stamp could make the daemon skip apt update.
+    """
+    path = update_stamp_path()
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with open(fd, 'w') as f:
+            f.write(clock.now().isoformat())
+    except OSError:
+        pass
+
+def lists_age():
+    """Seconds since the package lists were last refreshed, or None if unknown"""
+    # Empty lists always need an update
+    try:
+        if not any(entry.is_file() and entry.name != 'lock'
+                   for entry in os.scandir(apt_lists_dir)):
+            return None
+    except OSError:
+        return None
+    
+    stamps = [update_stamp_path()]
+    if not config['mirror_mode']:
+        # Also honour updates done by apt's periodic job or an admin
+        stamps.append(apt_success_stamp)
+    mtimes = [os.path.getmtime(path) for path in stamps if os.path.exists(path)]
+    if not mtimes:
+        return None
+    return max(0, time.time() - max(mtimes))
+
+def update_if_stale(logger):
+    """Run update_system() unless the lists are fresher than the configured age"""
+    max_age = config['update_max_age_minutes'] * 60
+    age = lists_age()
+    if age is not None and age < max_age:
+        logger.info(f"Package lists updated {int(age // 60)} minutes ago, skipping apt update")
+        return True
+    return update_system(logger)
+
 def update_system(logger):
     """Update system packages"""
     logger.info("Updating system packages...")
     try:
-        result = subprocess.run(
-            ['apt', 'update'],
-            timeout=300,
-            capture_output=True,
-            text=True
-        )
-        if result.returncode == 0:
+        if apt_backend is not None:
+            apt_backend.update()
+            logger.info("System updated successfully")
+            touch_update_stamp()
+            return True
+        
+        ok, error = run_apt(apt_command('apt', 'update'), timeout=config['update_timeout'], dpkg_lock=False)
+        if ok:
             logger.info("System updated successfully")
+            touch_update_stamp()
             return True
         else:
-            logger.warning(f"Update had issues: {result.stderr[:200]}")
+            logger.warning(f"Update had issues: {error[:200]}")
             return True
     except subprocess.TimeoutExpired:
         logger.error("Update timed out")
@@ -514,23 +1968,234 @@ def update_system(logger):
         logger.error(f"Update error: {e}")
         return False
 
+def apt_lists_fingerprint():
+    """Fingerprint the apt package lists and the app catalogue"""
+    digest = hashlib.sha1()
+    digest.update('\n'.join(UBUNTU_2404_APPS).encode())
+    try:
+        entries = sorted(os.scandir(apt_lists_dir), key=lambda e: e.name)
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.is_file() or entry.name == 'lock':
+            continue
+        st = entry.stat()
+        digest.update(f"{entry.name}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def read_package_cache(fingerprint):
+    """Return the cached catalogue view if it matches the current apt lists"""
+    if fingerprint is None or not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached.get('fingerprint') == fingerprint:
+            return cached['packages']
+    except Exception:
+        pass
+    return None
+
+def write_package_cache(fingerprint, packages):
+    """Atomically persist the catalogue view
+    
+    The daemon runs with umask 0, so the file gets an explicit mode: a
+    writable cache would let any local user decide what is installable.
+    """
+    if fingerprint is None:
+        return
+    tmp_file = cache_file + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode=0o755, exist_ok=True)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with open(fd, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'packages': packages},
+                      f, separators=(',', ':'))
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+def parse_package_records(text):
+    """Parse apt-cache show output into {name: {version, size, installed_size}}"""
+    packages = {}
+    for stanza in text.split('\n\n'):
+        fields = {}
+        for line in stanza.splitlines():
+            if line[:1] in (' ', '\t') or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            fields[key] = value.strip()
+        name = fields.get('Package')
+        if not name or name in packages:
+            continue
+        packages[name] = {
+            'version': fields.get('Version'),
+            'size': int(fields.get('Size', 0) or 0),
+            'installed_size': int(fields.get('Installed-Size', 0) or 0) * 1024,
+        }
+    return packages
+
+def load_package_index(logger=None, refresh=False):
+    """Build the catalogue availability index, reusing the on-disk cache when valid"""
+    global package_index
+    
+    if package_index is not None and not refresh:
+        return package_index
+    
+    fingerprint = apt_lists_fingerprint()
+    cached = read_package_cache(fingerprint)
+    if cached is not None:
+        package_index = cached
+        if logger:
+            logger.info(f"Package index loaded from cache: {len(package_index)} packages")
+        return package_index
+    
+    try:
+        if apt_backend is not None:
+            package_index = apt_backend.package_records(sorted(set(UBUNTU_2404_APPS)))
+            write_package_cache(fingerprint, package_index)
+            if logger:
+                logger.info(f"Package index built: {len(package_index)}/{len(set(UBUNTU_2404_APPS))} catalogue packages available")
+            return package_index
+        
+        result = run_command(apt_command('apt-cache', 'pkgnames'), timeout=60)
+        if result.returncode != 0:
+            if logger:
+                logger.warning(f"Could not build package index: {result.stderr[:200]}")
+            return package_index
+        
+        known = set(result.stdout.split())
+        available = sorted(set(UBUNTU_2404_APPS) & known)
+        
+        # One bulk lookup for candidate version and sizes of the catalogue
+        packages = {}
+        if available:
+            result = run_command(
+                apt_command('apt-cache', 'show', '--no-all-versions', *available),
+                timeout=60
+            )
+            packages = parse_package_records(result.stdout)
+        for app in available:
+            packages.setdefault(app, {'version': None, 'size': 0, 'installed_size': 0})
+        
+        package_index = packages
+        write_package_cache(fingerprint, package_index)
+        if logger:
+            logger.info(f"Package index built: {len(package_index)}/{len(set(UBUNTU_2404_APPS))} catalogue packages available")
+    except Exception as e:
+        if logger:
+            logger.warning(f"Could not build package index: {e}")
+    
+    return package_index
+
 def check_package_exists(package_name):
     """Check if a package exists in the repositories"""
+    index = load_package_index()
+    if index is not None:
+        return package_name in index
+    
+    # Index unavailable - fall back to asking apt-cache directly
     try:
-        result = subprocess.run(
-            ['apt-cache', 'search', '--names-only', f'^{package_name}$'],
-            capture_output=True,
-            text=True,
-            timeout=30
+        result = run_command(
+            apt_command('apt-cache', 'search', '--names-only', f'^{package_name}$'),
+            timeout=30,
+            packages=[package_name]
         )
         return result.returncode == 0 and package_name in result.stdout
     except:
         return False
 
-def install_batch(apps_list, batch_num, total_batches, logger):
-    """Install a batch of apps with package validation"""
-    logger.info(f"Installing batch {batch_num}: {len(apps_list)} apps")
+def query_install_state(packages):
+    """Return {package: dpkg state} for all packages with one dpkg-query call"""
+    if apt_backend is not None:
+        return apt_backend.install_state(packages)
+    
+    states = {app: 'not-installed' for app in packages}
+    if not packages:
+        return states
+    
+    # dpkg-query exits 1 when some names are unknown but still reports the rest
+    result = run_command(
+        ['dpkg-query', '-W', '-f', '${Package}\t${Status}\n'] + list(packages),
+        timeout=60
+    )
+    for line in result.stdout.splitlines():
+        name, _, status = line.partition('\t')
+        words = status.split()
+        if name in states and len(words) == 3:
+            states[name] = words[2]
+    return states
+
+def get_installed_packages(packages):
+    """Return the subset of packages that are fully installed"""
+    states = query_install_state(packages)
+    return [app for app in packages if states[app] == 'installed']
+
+def apt_install(packages, timeout, install_recommends=False):
+    """Install packages in one apt transaction, returning (ok, error_text)"""
+    if apt_backend is not None:
+        return apt_backend.commit(install=packages, install_recommends=install_recommends)
+    
+    cmd = apt_command('apt', 'install', '-y')
+    if not install_recommends:
+        cmd.append('--no-install-recommends')
+    return run_apt(cmd + list(packages), timeout, packages)
+
+def apt_remove(packages, timeout):
+    """Purge packages in one apt transaction, returning (ok, error_text)"""
+    if apt_backend is not None:
+        return apt_backend.commit(remove=packages)
     
+    return run_apt(apt_command('apt', 'remove', '-y', '--purge', *packages), timeout, packages)
+
+def apt_swap(remove, install, timeout):
+    """Purge one set of packages and install another in a single apt transaction"""
+    if apt_backend is not None:
+        return apt_backend.commit(install=install, remove=remove)
+    
+    # 'pkg-' removes within an install transaction; --purge turns that into a purge
+    return run_apt(
+        apt_command('apt', 'install', '-y', '--no-install-recommends', '--purge',
+                    *install, *[f"{app}-" for app in remove]),
+        timeout,
+        list(install) + list(remove)
+    )
+
+def bisect_transaction(packages, attempt, action, logger):
+    """Retry halves of a failed transaction recursively to isolate bad packages
+    
+    attempt(packages) runs one apt transaction and returns (ok, error_text).
+    Returns the packages that went through successfully.
+    """
+    if len(packages) < 2:
+        return []
+    
+    done = []
+    middle = len(packages) // 2
+    for half in (packages[:middle], packages[middle:]):
+        if shutdown_flag:
+            logger.info(f"  Shutdown requested, not retrying: {', '.join(half)}")
+            continue
+        try:
+            ok, error = attempt(half)
+        except subprocess.TimeoutExpired:
+            ok, error = False, "timed out"
+        except Exception as e:
+            ok, error = False, str(e)
+        
+        if ok:
+            done.extend(half)
+            logger.info(f"  ✓ {action.capitalize()} succeeded: {', '.join(half)}")
+        elif len(half) == 1:
+            logger.warning(f"  ✗ Failed to {action} {half[0]}: {error[:100]}")
+        else:
+            done.extend(bisect_transaction(half, attempt, action, logger))
+    return done
+
+def validate_batch(apps_list, batch_num, logger):
+    """Return the packages of a batch that exist in the repositories"""
     # Filter out packages that don't exist
     valid_apps = []
     for app in apps_list:
@@ -541,223 +2206,1034 @@ def install_batch(apps_list, batch_num, total_batches, logger):
     
     if not valid_apps:
         logger.error(f"No valid packages in batch {batch_num}")
-        return False
+    else:
+        logger.info(f"Valid packages: {len(valid_apps)}/{len(apps_list)}")
+    return valid_apps
+
+def install_batch(apps_list, batch_num, total_batches, logger, valid_apps=None):
+    """Install a batch of apps with package validation
     
-    logger.info(f"Valid packages: {len(valid_apps)}/{len(apps_list)}")
+    valid_apps skips the validation when prepare_batch already did it.
+    """
+    logger.info(f"Installing batch {batch_num}: {len(apps_list)} apps")
     
-    try:
-        # Install all valid apps in batch
-        result = subprocess.run(
-            ['apt', 'install', '-y', '--no-install-recommends'] + valid_apps,
-            timeout=600,  # 10 minute timeout
-            capture_output=True,
-            text=True
-        )
-        
-        if result.returncode == 0:
-            logger.info(f"✓ Batch {batch_num} installed successfully")
-            return True
-        else:
-            logger.warning(f"⚠ Batch {batch_num} installation failed")
-            logger.debug(f"Error: {result.stderr[:500]}")
-            
-            # Try installing individually with recommended packages
-            success_count = 0
-            for app in valid_apps:
-                try:
-                    app_result = subprocess.run(
-                        ['apt', 'install', '-y', app],
-                        timeout=180,
-                        capture_output=True,
-                        text=True
-                    )
-                    if app_result.returncode == 0:
-                        success_count += 1
-                        logger.info(f"  ✓ Installed {app}")
-                    else:
-                        logger.warning(f"  ✗ Failed to install {app}: {app_result.stderr[:100]}")
-                except subprocess.TimeoutExpired:
-                    logger.warning(f"  ✗ Timeout installing {app}")
-                except Exception as e:
-                    logger.warning(f"  ✗ Error installing {app}: {e}")
-            
-            logger.info(f"  Individual installs: {success_count}/{len(valid_apps)} successful")
-            return success_count > 0
-            
-    except subprocess.TimeoutExpired:
-        logger.error(f"✗ Batch {batch_num} installation timed out")
-        return False
-    except Exception as e:
-        logger.error(f"✗ Batch {batch_num} error: {e}")
+    if valid_apps is None:
+        with timed_phase('validation', batch_num, packages=len(apps_list)):
+            valid_apps = validate_batch(apps_list, batch_num, logger)
+    if not valid_apps:
         return False
+    
+    with timed_phase('install', batch_num, packages=len(valid_apps), bytes=batch_bytes(valid_apps)):
+        try:
+            # Install all valid apps in batch
+            ok, error = apt_install(valid_apps, timeout=config['install_timeout'])
+            
+            if ok:
+                logger.info(f"✓ Batch {batch_num} installed successfully")
+                return True
+            else:
+                logger.warning(f"⚠ Batch {batch_num} installation failed")
+                logger.debug(f"Error: {error[:500]}")
+                
+                # Bisect the batch so a bad package costs O(log n) apt runs
+                installed = bisect_transaction(
+                    valid_apps,
+                    lambda packages: apt_install(packages, timeout=min(
+                        config['install_timeout'], config['retry_install_timeout'] * len(packages))),
+                    "install",
+                    logger
+                )
+                logger.info(f"  Bisected installs: {len(installed)}/{len(valid_apps)} successful")
+                return len(installed) > 0
+                
+        except subprocess.TimeoutExpired:
+            logger.error(f"✗ Batch {batch_num} installation timed out")
+            return False
+        except Exception as e:
+            logger.error(f"✗ Batch {batch_num} error: {e}")
+            return False
 
 def uninstall_batch(apps_list, batch_num, total_batches, logger):
     """Uninstall a batch of apps"""
     logger.info(f"Uninstalling batch {batch_num}: {len(apps_list)} apps")
     
+    with timed_phase('removal', batch_num) as timing:
+        try:
+            # First, get list of actually installed packages
+            installed_apps = get_installed_packages(apps_list)
+            
+            if not installed_apps:
+                logger.info(f"No packages from batch {batch_num} are installed")
+                return True
+            timing['packages'] = len(installed_apps)
+            
+            # Uninstall installed apps
+            ok, error = apt_remove(installed_apps, timeout=config['remove_timeout'])
+            
+            if ok:
+                logger.info(f"✓ Batch {batch_num} uninstalled successfully")
+                return True
+            else:
+                logger.warning(f"⚠ Batch {batch_num} uninstallation had issues")
+                
+                # Bisect the batch so a bad package costs O(log n) apt runs
+                removed = bisect_transaction(
+                    installed_apps,
+                    lambda packages: apt_remove(packages, timeout=min(
+                        config['remove_timeout'], config['retry_remove_timeout'] * len(packages))),
+                    "remove",
+                    logger
+                )
+                logger.info(f"  Bisected removals: {len(removed)}/{len(installed_apps)} successful")
+                return True
+                
+        except subprocess.TimeoutExpired:
+            logger.error(f"✗ Batch {batch_num} uninstallation timed out")
+            return False
+        except Exception as e:
+            logger.error(f"✗ Batch {batch_num} uninstall error: {e}")
+            return False
+
+def swap_batch(old_apps, new_apps, old_num, new_num, logger, valid_new=None):
+    """Purge batch old_num and install batch new_num in one apt transaction
+    
+    Falls back to a separate uninstall and install if the combined run fails.
+    valid_new is the new batch as validated by prepare_batch, if it ran.
+    Returns True if the new batch was (at least partly) installed.
+    """
+    logger.info(f"Swapping batch {old_num} for batch {new_num}")
+    
     try:
-        # First, get list of actually installed packages
-        installed_apps = []
-        for app in apps_list:
-            result = subprocess.run(
-                ['dpkg', '-l', app],
-                capture_output=True,
-                text=True
-            )
-            if result.returncode == 0 and 'ii' in result.stdout:
-                installed_apps.append(app)
+        installed_old = get_installed_packages(old_apps)
+        if valid_new is None:
+            with timed_phase('validation', new_num, packages=len(new_apps)):
+                valid_new = validate_batch(new_apps, new_num, logger)
         
-        if not installed_apps:
-            logger.info(f"No packages from batch {batch_num} are installed")
-            return True
+        # Packages in both batches simply stay installed
+        keep = set(installed_old) & set(valid_new)
+        remove = [app for app in installed_old if app not in keep]
+        install = [app for app in valid_new if app not in keep]
         
-        # Uninstall installed apps
-        result = subprocess.run(
-            ['apt', 'remove', '-y', '--purge'] + installed_apps,
-            timeout=300,
-            capture_output=True,
-            text=True
-        )
+        if not remove:
+            return install_batch(new_apps, new_num, "unknown", logger, valid_new)
+        if not install:
+            # Only purge what the new batch doesn't need; keep stays installed
+            uninstall_batch(remove, old_num, "unknown", logger)
+            return bool(valid_new)
         
-        if result.returncode == 0:
-            logger.info(f"✓ Batch {batch_num} uninstalled successfully")
+        with timed_phase('swap', new_num, removed=len(remove), packages=len(install),
+                         bytes=batch_bytes(install)):
+            ok, error = apt_swap(remove, install, timeout=config['swap_timeout'])
+        if ok:
+            logger.info(f"✓ Swapped batch {old_num} ({len(remove)} removed) for batch {new_num} ({len(install)} installed)")
             return True
-        else:
-            logger.warning(f"⚠ Batch {batch_num} uninstallation had issues")
-            
-            # Try uninstalling individually
-            for app in installed_apps:
-                subprocess.run(
-                    ['apt', 'remove', '-y', '--purge', app],
-                    timeout=60,
-                    capture_output=True
-                )
-            return True
-            
+        
+        logger.warning("⚠ Swap transaction failed, falling back to separate remove and install")
+        logger.debug(f"Error: {error[:500]}")
     except subprocess.TimeoutExpired:
-        logger.error(f"✗ Batch {batch_num} uninstallation timed out")
-        return False
+        logger.warning("⚠ Swap transaction timed out, falling back to separate remove and install")
     except Exception as e:
-        logger.error(f"✗ Batch {batch_num} uninstall error: {e}")
-        return False
+        logger.warning(f"⚠ Swap error ({e}), falling back to separate remove and install")
+    
+    uninstall_batch(old_apps, old_num, "unknown", logger)
+    return install_batch(new_apps, new_num, "unknown", logger, valid_new)
+
+def scan_archive_cache():
+    """Return [(package, version, path, size, mtime)] for the .debs in archive_dir"""
+    debs = []
+    try:
+        entries = list(os.scandir(archive_dir))
+    except OSError:
+        return debs
+    for entry in entries:
+        if not entry.name.endswith('.deb') or not entry.is_file():
+            continue
+        parts = entry.name[:-len('.deb')].split('_')
+        if len(parts) != 3:
+            continue
+        st = entry.stat()
+        # apt stores epochs in file names as %3a
+        version = parts[1].replace('%3a', ':')
+        debs.append((parts[0], version, entry.path, st.st_size, st.st_mtime))
+    return debs
+
+def record_archive_hits(apps_list, logger):
+    """Count which apps of a batch already have their candidate .deb cached
+    
+    Hits are touched so they count as recently used for eviction.
+    """
+    cached = {}
+    for package, version, path, _, _ in scan_archive_cache():
+        cached[(package, version)] = path
+    
+    index = load_package_index() or {}
+    hits = 0
+    for app in apps_list:
+        version = index.get(app, {}).get('version')
+        path = cached.get((app, version))
+        if path:
+            hits += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        else:
+            archive_stats['miss_bytes'] += index.get(app, {}).get('size', 0)
+    
+    archive_stats['hits'] += hits
+    archive_stats['misses'] += len(apps_list) - hits
+    logger.info(f"Archive cache: {hits}/{len(apps_list)} cached, session hit rate {archive_hit_rate():.0%}")
+
+def archive_hit_rate():
+    """Fraction of batch packages found in the archive cache this session"""
+    lookups = archive_stats['hits'] + archive_stats['misses']
+    return archive_stats['hits'] / lookups if lookups else 0.0
+
+def prune_archive_cache(logger):
+    """Trim archive_dir to the byte budget, evicting least recently used .debs
+    
+    Returns the number of bytes freed. Superseded versions of catalogue packages and debs for packages outside
+    the catalogue go first, then catalogue debs in LRU order.
+    """
+    budget = config['archive_budget_mb'] * 1024 * 1024
+    debs = scan_archive_cache()
+    total = sum(deb[3] for deb in debs)
+    
+    index = load_package_index() or {}
+    catalogue = set(UBUNTU_2404_APPS)
+    
+    def keep_priority(deb):
+        package, version = deb[0], deb[1]
+        current = package in catalogue and index.get(package, {}).get('version') in (None, version)
+        return (current, deb[4])
+    
+    evicted = 0
+    freed = 0
+    for package, version, path, size, _ in sorted(debs, key=keep_priority):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        freed += size
+        evicted += 1
+    
+    logger.info(
+        f"Archive cache: {total // (1024*1024)} MB kept (budget {config['archive_budget_mb']} MB), "
+        f"evicted {evicted} debs / {freed // (1024*1024)} MB, session hit rate {archive_hit_rate():.0%}"
+    )
+    return freed
 
 def cleanup_system(logger):
     """Clean up system after operations"""
     logger.info("Performing system cleanup...")
     
     try:
-        subprocess.run(
-            ['apt', 'autoremove', '-y'],
-            timeout=180,
-            capture_output=True
-        )
-        subprocess.run(
-            ['apt', 'autoclean'],
-            timeout=60,
-            capture_output=True
-        )
+        with timed_phase('autoremove'):
+            if apt_backend is not None:
+                apt_backend.autoremove()
+            else:
+                run_apt(apt_command('apt', 'autoremove', '-y', '--purge'), timeout=config['cleanup_timeout'])
+        # Keep .debs the sampler is likely to pick again instead of autoclean
+        with timed_phase('autoclean') as timing:
+            timing['bytes'] = prune_archive_cache(logger)
         logger.info("System cleanup completed")
     except:
         logger.warning("Cleanup had issues")
 
-def main_installation():
-    """Main installation process - runs in background"""
-    global shutdown_flag
+async def prepare_batch(apps_list, batch_num, logger):
+    """Do the ahead-of-time work for an upcoming batch
+    
+    Validates the batch against the package index, totals its download and
+    installed sizes, checks disk space and downloads its debs with
+    --download-only. Runs concurrently with the hold of the current batch.
+    The download still holds the dpkg and archives locks while it runs, so
+    it blocks other lock holders (unattended-upgrades included) meanwhile,
+    and the next dpkg step of run_batches waits for it.
+    """
+    with timed_phase('validation', batch_num, packages=len(apps_list)):
+        valid_apps = validate_batch(apps_list, batch_num, logger)
+    if not valid_apps:
+        return valid_apps
     
-    # Setup logging
-    logger = setup_logging()
+    index = load_package_index() or {}
+    download_bytes = sum(index.get(app, {}).get('size', 0) for app in valid_apps)
+    installed_bytes = sum(index.get(app, {}).get('installed_size', 0) for app in valid_apps)
     
-    logger.info("="*60)
-    logger.info("BACKGROUND BATCH APP INSTALLER STARTED")
-    logger.info(f"Start time: {datetime.now()}")
-    logger.info(f"Working directory: {os.getcwd()}")
-    logger.info("="*60)
+    free_bytes = shutil.disk_usage(archive_dir if os.path.isdir(archive_dir) else '/').free
+    if free_bytes < download_bytes + installed_bytes:
+        logger.warning(
+            f"⚠ Low disk space for next batch: {free_bytes // (1024*1024)} MB free, "
+            f"needs ~{(download_bytes + installed_bytes) // (1024*1024)} MB; skipping pre-download"
+        )
+        return valid_apps
     
-    # Update system first
-    logger.info("Updating package lists...")
-    subprocess.run(['apt', 'update'], capture_output=True)
+    logger.info(f"Pre-downloading next batch in background (~{download_bytes // (1024*1024)} MB): {', '.join(valid_apps)}")
+    if isinstance(apt_backend, FakePackageBackend):
+        with timed_phase('download', batch_num, packages=len(valid_apps), bytes=download_bytes):
+            await apt_backend.download(valid_apps)
+        logger.info("✓ Pre-download completed")
+        return valid_apps
     
-    # Total number of apps to install/uninstall (161-199)
-    total_apps = random.randint(161, 199)
-    logger.info(f"Total apps to process: {total_apps}")
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *apt_command('apt', 'install', '-y', '--download-only', '--no-install-recommends', *valid_apps),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except Exception as e:
+        logger.warning(f"Could not start pre-download: {e}")
+        return valid_apps
     
-    # Process apps in batches
-    processed_apps = 0
-    batch_number = 0
+    # asyncio reaps this child itself, so its usage is accounted by difference
+    usage_before = children_usage_snapshot()
+    with timed_phase('download', batch_num, packages=len(valid_apps), bytes=download_bytes):
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), config['download_timeout'])
+            if process.returncode == 0:
+                logger.info("✓ Pre-download completed")
+            else:
+                logger.warning(f"⚠ Pre-download had issues: {stderr.decode(errors='replace')[:200]}")
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            logger.warning("⚠ Pre-download timed out, install will fetch the rest")
+        except asyncio.CancelledError:
+            # Session is stopping - don't leave apt downloading behind us
+            process.kill()
+            await process.wait()
+            raise
+        finally:
+            account_unattributed(usage_before, batch_num, valid_apps)
+    return valid_apps
+
+async def finish_prepare(task, logger):
+    """Wait for an upcoming batch's preparation before its dpkg run starts
+    
+    Returns the batch's valid packages, or None without a finished
+    preparation. Returns early on shutdown, leaving the task for
+    run_batches to cancel.
+    """
+    if task is None:
+        return None
+    if not task.done():
+        logger.info("Waiting for pre-download to finish...")
+        shutdown_wait = asyncio.ensure_future(shutdown_event.wait())
+        try:
+            await asyncio.wait({task, shutdown_wait}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            shutdown_wait.cancel()
+        if not task.done():
+            return None
+    try:
+        return await task
+    except Exception as e:
+        logger.warning(f"⚠ Batch preparation failed: {e}")
+        return None
+
+async def wait_interruptible(seconds, skippable=False):
+    """Sleep for up to seconds, returning as soon as shutdown is requested
+    
+    With skippable, the control API's skip-hold also ends the wait.
+    """
+    waiters = [asyncio.ensure_future(shutdown_event.wait())]
+    if skippable:
+        skip_event.clear()
+        waiters.append(asyncio.ensure_future(skip_event.wait()))
+    session['wait_until'] = clock.time() + seconds
+    try:
+        await asyncio.wait(waiters, timeout=seconds, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        session['wait_until'] = None
+        for waiter in waiters:
+            waiter.cancel()
+
+async def wait_unpaused(logger):
+    """Hold off the next apt transaction while the session is paused"""
+    if unpaused_event.is_set() or shutdown_flag:
+        return
+    logger.info("Paused, waiting for resume...")
+    state = session['state']
+    set_state('paused')
+    waiters = [asyncio.ensure_future(shutdown_event.wait()),
+               asyncio.ensure_future(unpaused_event.wait())]
+    try:
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+    set_state(state)
+    if not shutdown_flag:
+        logger.info("Resumed")
+
+def status_snapshot():
+    """Structured session status served by the control API"""
+    now = clock.time()
+    done = session['processed_apps'] - session['started_apps']
+    remaining = session['total_apps'] - session['processed_apps']
+    eta = None
+    if session['started'] is not None and done > 0:
+        eta = round((now - session['started']) / done * remaining)
+    return {
+        'pid': os.getpid(),
+        'state': session['state'],
+        'paused': unpaused_event is not None and not unpaused_event.is_set(),
+        'batch': current_batch,
+        'batch_apps': session['batch_apps'],
+        'batches': session['batches'],
+        'processed_apps': session['processed_apps'],
+        'total_apps': session['total_apps'],
+        'progress': {
+            'phase': apt_progress['phase'],
+            'percent': round(apt_progress['percent'], 1),
+            'message': apt_progress['message'],
+        },
+        'wait_remaining': None if session['wait_until'] is None else max(0, round(session['wait_until'] - now)),
+        'throttle': session['throttle'],
+        'eta_seconds': eta,
+    }
+
+def control_command(command, logger):
+    """Execute one control API command; returns the JSON reply"""
+    if command == 'status':
+        return dict(status_snapshot(), ok=True)
+    if command == 'stop':
+        request_shutdown()
+        return {'ok': True}
+    if command == 'pause':
+        if unpaused_event.is_set():
+            logger.info("Pause requested, no new apt transaction will start")
+        unpaused_event.clear()
+        return {'ok': True}
+    if command == 'resume':
+        unpaused_event.set()
+        return {'ok': True}
+    if command == 'reload':
+        ok, result = reload_config(logger)
+        return {'ok': True, 'changes': result} if ok else {'ok': False, 'error': result}
+    if command == 'skip-hold':
+        if session['wait_until'] is None:
+            return {'ok': False, 'error': 'not waiting'}
+        logger.info(f"Skipping the rest of the {session['state']} wait")
+        skip_event.set()
+        return {'ok': True}
+    return {'ok': False, 'error': f"unknown command: {command}"}
+
+async def handle_control(reader, writer, logger):
+    """Serve one JSON-line request on the control socket"""
+    try:
+        request = json.loads(await asyncio.wait_for(reader.readline(), 5) or b'{}')
+        command = request.get('command')
+        # Anyone may read status; changing the session needs the daemon's uid or root
+        sock = writer.get_extra_info('socket')
+        _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                        struct.calcsize('3i')))
+        if command != 'status' and uid not in (0, os.getuid()):
+            reply = {'ok': False, 'error': 'permission denied'}
+        else:
+            reply = control_command(command, logger)
+    except (ValueError, AttributeError, asyncio.TimeoutError) as e:
+        reply = {'ok': False, 'error': f"bad request: {e}"}
+    try:
+        writer.write((json.dumps(reply) + '\n').encode())
+        await writer.drain()
+        writer.close()
+    except OSError:
+        pass
+
+async def start_control_server(logger):
+    """Listen on control_socket; returns the server or None"""
+    try:
+        if os.path.exists(control_socket):
+            os.remove(control_socket)
+        server = await asyncio.start_unix_server(
+            lambda reader, writer: handle_control(reader, writer, logger), path=control_socket)
+        os.chmod(control_socket, 0o666)
+    except OSError as e:
+        logger.warning(f"⚠ Control socket unavailable: {e}")
+        return None
+    return server
+
+def control_request(command, timeout=5):
+    """Send one command to the daemon's control socket; returns the reply or None"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(control_socket)
+            sock.sendall((json.dumps({'command': command}) + '\n').encode())
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data)
+    except (OSError, ValueError):
+        return None
+
+def dump_profile(logger, final=False):
+    """Write the pstats file and append a tracemalloc snapshot next to the log
+    
+    Interim dumps (final=False) only happen once per profile_interval and
+    resume profiling afterwards.
+    """
+    global last_profile_dump
+    if profiler is None:
+        return
+    now = time.monotonic()
+    if not final and now - last_profile_dump < config['profile_interval']:
+        return
+    last_profile_dump = now
     
-    while processed_apps < total_apps and not shutdown_flag:
-        batch_number += 1
-        
-        # Check for shutdown flag
+    # Keep the dump itself out of the profile
+    profiler.disable()
+    try:
+        profile_stats().dump_stats(profile_file)
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:25]
+        with open(tracemalloc_file, 'a') as f:
+            f.write(f"=== {clock.now()} batch {current_batch}: "
+                    f"current {current // 1024} KiB, peak {peak // 1024} KiB\n")
+            for stat in statistics:
+                f.write(f"{stat}\n")
+            f.write("\n")
+        logger.info(f"Profile dumped: {profile_file}, traced memory {current // 1024} KiB (peak {peak // 1024} KiB)")
+    except OSError as e:
+        logger.warning(f"⚠ Could not dump profile: {e}")
+    finally:
+        if not final:
+            profiler.enable()
+
+def profile_stats():
+    """pstats.Stats of the main profiler merged with the worker-thread steps"""
+    stats = pstats.Stats(profiler)
+    with worker_stats_lock:
+        if worker_stats is not None:
+            stats.add(worker_stats)
+    return stats
+
+def run_step(func, *args):
+    """Run a blocking step in the worker thread, profiled with --profile
+    
+    cProfile only sees the thread that enabled it, so each step gets its
+    own profiler, merged into worker_stats afterwards. From Python 3.12 the
+    profiler covers every thread and a second one cannot be enabled.
+    """
+    global worker_stats
+    if profiler is None:
+        return clock.run(func, *args)
+    step_profiler = cProfile.Profile()
+    try:
+        step_profiler.enable()
+    except ValueError:
+        return clock.run(func, *args)
+    try:
+        return clock.run(func, *args)
+    finally:
+        step_profiler.disable()
+        with worker_stats_lock:
+            if worker_stats is None:
+                worker_stats = pstats.Stats(step_profiler)
+            else:
+                worker_stats.add(step_profiler)
+
+def run_profiled(func):
+    """Run func under cProfile and tracemalloc, dumping stats next to the log"""
+    global profiler, last_profile_dump, worker_stats
+    logger = logging.getLogger(__name__)
+    
+    tracemalloc.start(25)
+    worker_stats = None
+    profiler = cProfile.Profile()
+    last_profile_dump = time.monotonic()
+    profiler.enable()
+    try:
+        func()
+    finally:
+        dump_profile(logger, final=True)
+        stream = io.StringIO()
+        stats = profile_stats()
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(20)
+        logger.info("Top functions by cumulative time:\n" + stream.getvalue())
+        tracemalloc.stop()
+        profiler = None
+        worker_stats = None
+
+def read_pressure(resource_name):
+    """avg10 of the 'some' line in /proc/pressure/<resource>, or None without PSI"""
+    try:
+        with open(f"/proc/pressure/{resource_name}", 'r') as f:
+            for line in f:
+                if line.startswith('some '):
+                    return float(line.split()[1].split('=', 1)[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def host_load():
+    """Snapshot of host pressure, load per CPU and available memory (percent)"""
+    load = {name: read_pressure(name) for name in ('cpu', 'io', 'memory')}
+    load['load'] = os.getloadavg()[0] * 100 / (os.cpu_count() or 1)
+    load['mem_available'] = None
+    try:
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                meminfo[key] = int(value.split()[0])
+        load['mem_available'] = meminfo['MemAvailable'] * 100 / meminfo['MemTotal']
+    except (OSError, ValueError, KeyError, IndexError, ZeroDivisionError):
+        pass
+    return load
+
+def throttle_level(load):
+    """Classify a host_load() snapshot as 'high', 'idle' or 'normal'"""
+    if not config['throttle']:
+        return 'normal'
+    pressures = [load[name] for name in ('cpu', 'io', 'memory') if load[name] is not None]
+    if ((pressures and max(pressures) >= config['pressure_high'])
+            or load['load'] >= config['load_high_pct']
+            or (load['mem_available'] is not None and load['mem_available'] < config['mem_low_pct'])):
+        return 'high'
+    if all(p <= config['pressure_idle'] for p in pressures) and load['load'] <= config['load_idle_pct']:
+        return 'idle'
+    return 'normal'
+
+def assess_load(phase, logger):
+    """Read the host load before a phase; logs whenever the level changes"""
+    load = host_load()
+    level = throttle_level(load)
+    if level != session['throttle']:
+        pressures = ', '.join(
+            f"{name} {load[name]:.1f}%" for name in ('cpu', 'io', 'memory') if load[name] is not None
+        ) or "no PSI"
+        memory = '' if load['mem_available'] is None else f", {load['mem_available']:.0f}% memory available"
+        logger.info(f"Throttle before {phase}: host {level} "
+                    f"(pressure {pressures}, load {load['load']:.0f}%/CPU{memory})")
+        session['throttle'] = level
+        write_metrics()
+    return level
+
+def throttled_wait(seconds, level, what, logger):
+    """Stretch a hold or delay on a busy host, shorten it on an idle one"""
+    if level == 'high':
+        adjusted = seconds * config['hold_stretch_pct'] // 100
+    elif level == 'idle':
+        low = config['hold_minutes'][0] * 60 if what == 'hold' else config['delay_seconds'][0]
+        adjusted = min(seconds, low)
+    else:
+        return seconds
+    if adjusted != seconds:
+        logger.info(f"Throttle: {what} {seconds // 60}m{seconds % 60:02d}s -> "
+                    f"{adjusted // 60}m{adjusted % 60:02d}s (host {level})")
+    return adjusted
+
+async def settle_own_load(logger):
+    """Wait until our last dpkg step is load_settle_seconds behind us
+    
+    PSI avg10 and the 1-minute load average read right after our own apt
+    run mostly measure that run, and would throttle us for load we caused
+    ourselves. Returns the seconds waited, which count toward the hold or
+    delay the reading is for.
+    """
+    if not config['throttle'] or dpkg_step_end is None:
+        return 0
+    remaining = config['load_settle_seconds'] - (clock.monotonic() - dpkg_step_end)
+    if remaining <= 0:
+        return 0
+    logger.debug(f"Letting our own apt load settle for {remaining:.0f}s before reading host load")
+    await wait_interruptible(remaining)
+    return remaining
+
+async def defer_for_load(logger):
+    """Hold off an install while the host is busy, up to defer_max_minutes"""
+    # A cleanup may have just run
+    await settle_own_load(logger)
+    level = assess_load('install', logger)
+    if level != 'high':
+        return
+    limit = config['defer_max_minutes'] * 60
+    logger.info(f"Throttle: deferring install until the host calms down (at most {limit // 60} minutes)")
+    state = session['state']
+    set_state('deferred')
+    start = clock.monotonic()
+    with timed_phase('defer'):
+        while level == 'high' and not shutdown_flag:
+            # Stop at under a second left: float leftovers would make endless zero-length waits
+            remaining = limit - (clock.monotonic() - start)
+            if remaining < 1:
+                break
+            await wait_interruptible(min(60, remaining), skippable=True)
+            level = assess_load('install', logger)
+    set_state(state)
+    if not shutdown_flag:
+        logger.info(f"Throttle: install deferred {clock.monotonic() - start:.0f}s, host now {level}")
+
+def select_batch(processed_apps, total_apps, level='normal'):
+    """Pick the size and random apps for the next batch
+    
+    A busy host gets half-size batches, an idle one the largest size.
+    """
+    # Determine batch size (5-14 apps by default)
+    low, high = config['batch_size']
+    if level == 'high':
+        batch_size = random.randint(max(1, low // 2), max(1, high // 2))
+    elif level == 'idle':
+        batch_size = high
+    else:
+        batch_size = random.randint(low, high)
+    
+    # Adjust last batch size if needed
+    if processed_apps + batch_size > total_apps:
+        batch_size = total_apps - processed_apps
+    
+    # Select random apps for this batch
+    batch_apps = random.sample(UBUNTU_2404_APPS, min(batch_size, len(UBUNTU_2404_APPS)))
+    return batch_size, batch_apps
+
+def announce_batch(logger, batch_number, batch_size, processed_apps, total_apps, batch_apps):
+    """Log the header for a new batch"""
+    logger.info(f"\n{'='*50}")
+    logger.info(f"Starting batch {batch_number}")
+    logger.info(f"Batch size: {batch_size} apps")
+    logger.info(f"Progress: {processed_apps}/{total_apps} apps")
+    logger.info(f"Selected apps: {', '.join(batch_apps)}")
+
+async def removal_leftover(apps, preinstalled, batch_number, locked, logger):
+    """Packages this session installed that are still there after a removal
+    
+    Packages that were installed before the batch (preinstalled) are not
+    ours to chase, and apt may well refuse to remove them (dash, ...).
+    """
+    leftover = [app for app in await locked(get_installed_packages, apps) if app not in preinstalled]
+    if leftover:
+        logger.warning(f"⚠ Batch {batch_number} left installed, retried on resume: {', '.join(leftover)}")
+    return leftover
+
+async def resume_batches(resume, locked, logger):
+    """Finish the batches an interrupted session left open
+    
+    A batch that was holding keeps its remaining hold; anything else is
+    removed right away. Returns False if shutdown interrupted the resume.
+    """
+    if any(batch['state'] == 'selected' for batch in resume['open']):
+        # The session died mid-transaction; dpkg may need finishing first
+        logger.info("Interrupted apt transaction, running dpkg --configure -a...")
+        result = await locked(run_command, ['dpkg', '--configure', '-a'], 600)
+        if result.returncode != 0:
+            logger.warning(f"⚠ dpkg --configure -a had issues: {result.stderr[:200]}")
+    
+    for batch in resume['open']:
+        batch_number = batch['batch']
+        remaining = int(batch.get('until') or 0) - int(clock.time())
+        if batch['state'] == 'holding' and remaining > 0:
+            logger.info(f"Resuming hold of batch {batch_number}: {remaining // 60} minutes left")
+            set_state('holding')
+            with timed_phase('hold', batch_number, packages=batch['size']):
+                await wait_interruptible(remaining, skippable=True)
+        await wait_unpaused(logger)
         if shutdown_flag:
-            logger.info("Shutdown requested, stopping...")
-            break
-        
-        # Determine batch size (5-14 apps)
-        batch_size = random.randint(5, 14)
-        
-        # Adjust last batch size if needed
-        if processed_apps + batch_size > total_apps:
-            batch_size = total_apps - processed_apps
-        
-        # Select random apps for this batch
-        batch_apps = random.sample(UBUNTU_2404_APPS, min(batch_size, len(UBUNTU_2404_APPS)))
-        
-        logger.info(f"\n{'='*50}")
-        logger.info(f"Starting batch {batch_number}")
-        logger.info(f"Batch size: {batch_size} apps")
-        logger.info(f"Progress: {processed_apps}/{total_apps} apps")
-        logger.info(f"Selected apps: {', '.join(batch_apps)}")
+            return False
         
-        # Install the batch
-        if install_batch(batch_apps, batch_number, "unknown", logger):
-            logger.info(f"✓ Installation of batch {batch_number} completed")
+        set_state('removing')
+        removed = await locked(uninstall_batch, batch['apps'], batch_number, "unknown", logger)
+        count_result('remove', removed)
+        if batch['state'] == 'leftover':
+            # Already retried once; what apt still refuses to remove stays
+            leftover = await locked(get_installed_packages, batch['apps'])
+            if leftover:
+                logger.warning(f"⚠ Giving up on removing {', '.join(leftover)} from batch {batch_number}")
+            leftover = []
         else:
-            logger.warning(f"⚠ Installation of batch {batch_number} had issues")
-        
-        # Check for shutdown before delay
-        if shutdown_flag:
-            logger.info("Shutdown requested, stopping...")
-            break
-        
-        # Random delay between 7-16 minutes
-        delay_minutes = random.randint(7, 16)
-        delay_seconds = delay_minutes * 60
-        logger.info(f"Waiting {delay_minutes} minutes before uninstalling...")
+            leftover = await removal_leftover(batch['apps'], batch['preinstalled'], batch_number, locked, logger)
+        resume['processed_apps'] += batch['size']
+        resume['batches'] = max(resume['batches'], batch_number)
+        journal('removed', batch=batch_number, processed_apps=resume['processed_apps'], leftover=leftover)
+        session.update(batches=resume['batches'], processed_apps=resume['processed_apps'])
+        if not leftover:
+            logger.info(f"✓ Interrupted batch {batch_number} cleaned up")
+    return True
+
+async def run_batches(total_apps, logger, resume=None):
+    """Run the batch pipeline; returns (batches processed, apps processed)
+    
+    Steps that take the dpkg lock (install, swap, removal, cleanup) run one
+    at a time in a worker thread under dpkg_lock. Preparation of the next
+    batch runs as a task alongside the current batch's hold; its download
+    holds apt's archives lock, so the next dpkg step waits for it.
+    resume is read_journal()'s state of an interrupted session to continue.
+    """
+    global current_batch, shutdown_event, skip_event, unpaused_event
+    dpkg_lock = asyncio.Lock()
+    
+    # Signals now wake the loop directly instead of waiting for a poll
+    shutdown_event = asyncio.Event()
+    if shutdown_flag:
+        shutdown_event.set()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, request_shutdown)
+    loop.add_signal_handler(signal.SIGHUP, reload_config, logger)
+    if reload_pending:
+        reload_config(logger)
+    
+    skip_event = asyncio.Event()
+    unpaused_event = asyncio.Event()
+    unpaused_event.set()
+    server = await start_control_server(logger)
+    
+    async def locked(func, *args):
+        global dpkg_step_end
+        async with dpkg_lock:
+            try:
+                return await asyncio.to_thread(run_step, func, *args)
+            finally:
+                dpkg_step_end = clock.monotonic()
+    
+    # Process apps in batches
+    processed_apps = 0
+    batch_number = 0
+    
+    # Batch already installed by a swap transaction: (apps, size, preinstalled)
+    pending_batch = None
+    
+    # Next batch chosen ahead of time, its preparation task and the valid
+    # packages that preparation found
+    next_batch = None
+    next_task = None
+    prepared = None
+    
+    session.update(started=clock.time(), started_apps=resume['processed_apps'] if resume else 0)
+    
+    try:
+        if resume is not None:
+            resumed = await resume_batches(resume, locked, logger)
+            processed_apps, batch_number = resume['processed_apps'], resume['batches']
+            if not resumed:
+                return batch_number, processed_apps
         
-        # Break delay into smaller chunks to check shutdown flag
-        chunk_size = 30  # Check every 30 seconds
-        for i in range(0, delay_seconds, chunk_size):
+        while processed_apps < total_apps and not shutdown_flag:
+            batch_number += 1
+            current_batch = batch_number
+            
+            if pending_batch is not None:
+                batch_apps, batch_size, preinstalled = pending_batch
+                pending_batch = None
+            else:
+                if next_batch is not None:
+                    batch_size, batch_apps = next_batch
+                    next_batch = None
+                else:
+                    batch_size, batch_apps = select_batch(processed_apps, total_apps,
+                                                          assess_load('batch selection', logger))
+                    record_archive_hits(batch_apps, logger)
+                announce_batch(logger, batch_number, batch_size, processed_apps, total_apps, batch_apps)
+                
+                if next_task is not None:
+                    prepared = await finish_prepare(next_task, logger)
+                if shutdown_flag:
+                    logger.info("Shutdown requested, stopping...")
+                    break
+                next_task = None
+                
+                # Install the batch
+                await wait_unpaused(logger)
+                await defer_for_load(logger)
+                if shutdown_flag:
+                    break
+                # Packages already on the system are not chased if their removal fails
+                preinstalled = await locked(get_installed_packages, batch_apps)
+                journal('selected', batch=batch_number, apps=batch_apps, size=batch_size,
+                        preinstalled=preinstalled)
+                session['batch_apps'] = batch_apps
+                set_state('installing')
+                installed = await locked(install_batch, batch_apps, batch_number, "unknown", logger, prepared)
+                prepared = None
+                journal('installed', batch=batch_number)
+                count_result('install', installed)
+                if installed:
+                    logger.info(f"✓ Installation of batch {batch_number} completed")
+                else:
+                    logger.warning(f"⚠ Installation of batch {batch_number} had issues")
+            
+            # Check for shutdown before delay
             if shutdown_flag:
+                logger.info("Shutdown requested, stopping...")
                 break
-            time.sleep(min(chunk_size, delay_seconds - i))
-        
-        if shutdown_flag:
-            logger.info("Shutdown requested, stopping...")
-            break
-        
-        # Uninstall the batch
-        if uninstall_batch(batch_apps, batch_number, "unknown", logger):
-            logger.info(f"✓ Uninstallation of batch {batch_number} completed")
-        else:
-            logger.warning(f"⚠ Uninstallation of batch {batch_number} had issues")
-        
-        # Update processed count
-        processed_apps += batch_size
-        
-        # Random delay before next batch (1-3 minutes)
-        if processed_apps < total_apps and not shutdown_flag:
-            next_delay = random.randint(60, 180)
-            logger.info(f"Waiting {next_delay//60} minutes before next batch...")
             
-            for i in range(0, next_delay, chunk_size):
+            set_state('holding')
+            with timed_phase('hold', packages=batch_size):
+                # Read the host load once the install is no longer all it shows
+                settled = await settle_own_load(logger)
+                level = assess_load('hold', logger)
+                
+                # Choose the next batch now and prepare it while this one is held
+                if processed_apps + batch_size < total_apps and not shutdown_flag:
+                    next_batch = select_batch(processed_apps + batch_size, total_apps, level)
+                    record_archive_hits(next_batch[1], logger)
+                    next_task = asyncio.create_task(prepare_batch(next_batch[1], batch_number + 1, logger))
+                
+                # Random delay between 7-16 minutes by default
+                delay_minutes = random.randint(*config['hold_minutes'])
+                hold = throttled_wait(delay_minutes * 60, level, 'hold', logger)
+                logger.info(f"Waiting {hold // 60} minutes before uninstalling...")
+                journal('holding', batch=batch_number, until=round(clock.time() + hold - settled, 3))
+                await wait_interruptible(max(0, hold - settled), skippable=True)
+            await wait_unpaused(logger)
+            
+            if shutdown_flag:
+                logger.info("Shutdown requested, stopping...")
+                break
+            
+            leftover = []
+            if config['swap_mode'] and next_batch is not None:
+                # Purge this batch and install the next one in a single apt run
+                next_size, next_apps = next_batch
+                next_batch = None
+                prepared = await finish_prepare(next_task, logger)
                 if shutdown_flag:
+                    logger.info("Shutdown requested, stopping...")
                     break
-                time.sleep(min(chunk_size, next_delay - i))
-        
-        # Occasional cleanup
-        if batch_number % 3 == 0 and not shutdown_flag:
-            cleanup_system(logger)
+                next_task = None
+                await defer_for_load(logger)
+                if shutdown_flag:
+                    logger.info("Shutdown requested, stopping...")
+                    break
+                announce_batch(logger, batch_number + 1, next_size, processed_apps + batch_size, total_apps, next_apps)
+                # What this batch installed and the next one keeps counts as ours
+                next_preinstalled = [app for app in await locked(get_installed_packages, next_apps)
+                                     if app not in batch_apps or app in preinstalled]
+                journal('selected', batch=batch_number + 1, apps=next_apps, size=next_size,
+                        preinstalled=next_preinstalled)
+                session['batch_apps'] = next_apps
+                set_state('swapping')
+                swapped = await locked(swap_batch, batch_apps, next_apps, batch_number, batch_number + 1,
+                                       logger, prepared)
+                prepared = None
+                journal('installed', batch=batch_number + 1)
+                count_result('install', swapped)
+                if swapped:
+                    logger.info(f"✓ Swap to batch {batch_number + 1} completed")
+                else:
+                    logger.warning(f"⚠ Swap to batch {batch_number + 1} had issues")
+                # A failed swap falls back to a plain removal, which can fail too
+                leftover = await removal_leftover([app for app in batch_apps if app not in next_apps],
+                                                  preinstalled, batch_number, locked, logger)
+                pending_batch = (next_apps, next_size, next_preinstalled)
+            else:
+                # apt takes the archives lock for removals too, so let the
+                # pre-download finish first (this also clears the way for cleanup)
+                prepared = await finish_prepare(next_task, logger)
+                if shutdown_flag:
+                    logger.info("Shutdown requested, stopping...")
+                    break
+                next_task = None
+                
+                # Uninstall the batch
+                set_state('removing')
+                removed = await locked(uninstall_batch, batch_apps, batch_number, "unknown", logger)
+                count_result('remove', removed)
+                if removed:
+                    logger.info(f"✓ Uninstallation of batch {batch_number} completed")
+                else:
+                    logger.warning(f"⚠ Uninstallation of batch {batch_number} had issues")
+                leftover = await removal_leftover(batch_apps, preinstalled, batch_number, locked, logger)
+            
+            with usage_lock:
+                batch_usage = dict(usage_by_batch.get(batch_number, {}))
+            logger.info(f"Batch {batch_number} child resources: {format_usage(batch_usage)}")
+            
+            # Update processed count
+            processed_apps += batch_size
+            journal('removed', batch=batch_number, processed_apps=processed_apps, leftover=leftover)
+            session.update(batches=batch_number, processed_apps=processed_apps)
+            
+            # Random delay before next batch (1-3 minutes by default); a swap already installed it
+            if pending_batch is None and processed_apps < total_apps and not shutdown_flag:
+                set_state('waiting')
+                with timed_phase('delay'):
+                    settled = await settle_own_load(logger)
+                    next_delay = random.randint(*config['delay_seconds'])
+                    next_delay = throttled_wait(next_delay, assess_load('delay', logger), 'delay', logger)
+                    logger.info(f"Waiting {next_delay//60} minutes before next batch...")
+                    await wait_interruptible(max(0, next_delay - settled), skippable=True)
+            
+            # Occasional cleanup
+            if batch_number % config['cleanup_every'] == 0 and not shutdown_flag:
+                await wait_unpaused(logger)
+                set_state('cleaning')
+                await locked(cleanup_system, logger)
+            
+            dump_profile(logger)
+    finally:
+        # Don't leave a download running past the session
+        if next_task is not None:
+            next_task.cancel()
+            await asyncio.gather(next_task, return_exceptions=True)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+            signal.signal(signum, signal_handler)
+        loop.remove_signal_handler(signal.SIGHUP)
+        signal.signal(signal.SIGHUP, reload_handler)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            if os.path.exists(control_socket):
+                os.remove(control_socket)
+        shutdown_event = skip_event = unpaused_event = None
+    
+    return batch_number, processed_apps
+
+def main_installation():
+    """Main installation process - runs in background"""
+    global shutdown_flag
+    
+    # Setup logging
+    logger = setup_logging()
+    
+    logger.info("="*60)
+    logger.info("BACKGROUND BATCH APP INSTALLER STARTED")
+    logger.info(f"Start time: {clock.now()}")
+    logger.info(f"Working directory: {os.getcwd()}")
+    logger.info(f"Phase timings: {timings_file}")
+    logger.info(f"Metrics: {metrics_path()}")
+    logger.info(f"Session journal: {journal_file}")
+    logger.info("="*60)
+    
+    if config['mirror_mode'] and not enable_mirror_mode(logger):
+        return
+    
+    # Keep one apt cache open for the session when --libapt is given
+    init_apt_backend(logger)
+    
+    # Update package lists unless they are already fresh
+    set_state('updating')
+    with timed_phase('update', 0):
+        update_if_stale(logger)
+    
+    # Index available packages once so batch validation is a set lookup
+    load_package_index(logger, refresh=True)
+    
+    # Continue an interrupted session, or plan a new one
+    resume = read_journal()
+    if resume is not None:
+        total_apps = resume['total_apps']
+        logger.info(f"Resuming interrupted session: {resume['processed_apps']}/{total_apps} apps "
+                    f"after batch {resume['batches']}, {len(resume['open'])} batches to clean up")
+    else:
+        # Total number of apps to install/uninstall (161-199 by default)
+        total_apps = random.randint(*config['total_apps'])
+        journal('session', total_apps=total_apps)
+    logger.info(f"Total apps to process: {total_apps}")
+    session['total_apps'] = total_apps
+    if config['swap_mode']:
+        logger.info("Swap mode: removal and next install share one apt transaction")
+    
+    batch_number, processed_apps = clock.run_async(run_batches(total_apps, logger, resume))
     
     # Final cleanup
     logger.info("\n" + "="*50)
@@ -768,42 +3244,157 @@ def main_installation():
     
     logger.info(f"Total batches processed: {batch_number}")
     logger.info(f"Total apps installed/uninstalled: {processed_apps}")
+    logger.info(f"Archive cache hit rate: {archive_hit_rate():.0%} "
+                f"({archive_stats['hits']}/{archive_stats['hits'] + archive_stats['misses']})")
     
+    set_state('cleaning')
     cleanup_system(logger)
+    set_state('idle')
+    
+    log_usage_summary(logger)
     
     if shutdown_flag:
-        logger.info("Process stopped gracefully")
+        logger.info(f"Process stopped gracefully, next start resumes from {journal_file}")
     else:
+        clear_journal()
         logger.info("Process completed successfully!")
     
-    logger.info(f"End time: {datetime.now()}")
+    logger.info(f"End time: {clock.now()}")
     logger.info("="*60)
 
-def show_status():
-    """Show current status if running"""
+def format_duration(seconds):
+    """Render seconds as e.g. '2h 05m' or '7m 30s'"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m {seconds % 60:02d}s"
+
+def print_control_status(status):
+    """Print a status reply from the control API"""
+    state = status['state'] + (' (paused)' if status['paused'] and status['state'] != 'paused' else '')
+    print(f"✓ Background process is RUNNING (PID: {status['pid']})")
+    print(f"State: {state}")
+    print(f"Progress: {status['processed_apps']}/{status['total_apps']} apps, "
+          f"{status['batches']} batches done")
+    if status['batch']:
+        print(f"Batch {status['batch']}: {', '.join(status['batch_apps'])}")
+    progress = status['progress']
+    if progress['phase'] != 'idle':
+        print(f"apt: {progress['phase']} {progress['percent']:.0f}% {progress['message']}")
+    if status['wait_remaining'] is not None:
+        print(f"Wait remaining: {format_duration(status['wait_remaining'])}")
+    if status['eta_seconds'] is not None:
+        print(f"ETA: {format_duration(status['eta_seconds'])}")
+
+def show_status(as_json=False, follow=False):
+    """Show current status if running
+    
+    A running daemon answers over the control socket; the PID file, dpkg
+    and the log are only consulted when it does not. With follow, the log
+    is then followed until interrupted.
+    """
+    status = control_request('status')
+    if status is not None and status.get('ok'):
+        if as_json:
+            print(json.dumps(status, indent=2))
+        else:
+            print_control_status(status)
+        if follow:
+            print(f"\nFollowing {log_file} (Ctrl-C to stop):")
+            for line in tail_lines(log_file, 20) if os.path.exists(log_file) else []:
+                print(line)
+            follow_log(log_file)
+        return
+    
     is_running, pid = check_existing_process()
+    if as_json:
+        print(json.dumps({'ok': False, 'running': is_running, 'pid': pid}))
+        return
     
     if is_running:
         print(f"✓ Background process is RUNNING (PID: {pid})")
     else:
         print("✗ Background process is NOT running")
     
+    try:
+        catalogue = sorted(set(UBUNTU_2404_APPS))
+        installed = get_installed_packages(catalogue)
+        print(f"Catalogue packages installed: {len(installed)}/{len(catalogue)}")
+    except Exception as e:
+        print(f"Could not query installed packages: {e}")
+    
     print(f"\nLog file: {log_file}")
     
     if os.path.exists(log_file):
         print("\nLast 20 lines of log:")
         try:
-            with open(log_file, 'r') as f:
-                lines = f.readlines()[-20:]
-                for line in lines:
-                    print(line.strip())
+            for line in tail_lines(log_file, 20):
+                print(line.strip())
         except Exception as e:
             print(f"Could not read log file: {e}")
     else:
         print("\nLog file does not exist yet")
+    
+    if follow:
+        print(f"\nFollowing {log_file} (Ctrl-C to stop):")
+        follow_log(log_file)
+
+def wait_for_exit(pid, timeout):
+    """Wait up to timeout seconds for pid to exit; returns True if it has"""
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        # The pidfd becomes readable when the process exits
+        try:
+            return bool(select.select([fd], [], [], timeout)[0])
+        finally:
+            os.close(fd)
+    
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.2)
 
-def stop_process():
-    """Stop the running background process"""
+def package_manager_children(pid):
+    """Names of apt/dpkg processes the daemon is running right now"""
+    names = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return names
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        for child in children:
+            try:
+                with open(f"/proc/{child}/comm") as f:
+                    name = f.read().strip()
+            except OSError:
+                continue
+            if name.startswith(('apt', 'dpkg')):
+                names.append(name)
+    return names
+
+def stop_process(grace=None):
+    """Stop the running background process
+    
+    SIGTERM ends the daemon's waits immediately but lets a running apt
+    transaction finish. Only if the daemon is still alive after the grace
+    period (stop_grace_seconds) is it killed, which may interrupt dpkg.
+    """
+    grace = config['stop_grace_seconds'] if grace is None else grace
     is_running, pid = check_existing_process()
     
     if not is_running:
@@ -811,26 +3402,39 @@ def stop_process():
         return
     
     try:
-        # Send SIGTERM signal
-        os.kill(pid, signal.SIGTERM)
-        print(f"✓ Sent stop signal to process {pid}")
+        # Ask over the control socket, or send SIGTERM signal
+        reply = control_request('stop')
+        if reply is not None and reply.get('ok'):
+            print(f"✓ Sent stop request to process {pid}")
+        else:
+            os.kill(pid, signal.SIGTERM)
+            print(f"✓ Sent stop signal to process {pid}")
         
         # Wait for process to terminate
-        for i in range(10):
-            try:
-                os.kill(pid, 0)
-                print(f"Waiting for process to stop... ({i+1}/10)")
-                time.sleep(1)
-            except OSError:
+        deadline = time.monotonic() + grace
+        while True:
+            remaining = deadline - time.monotonic()
+            if wait_for_exit(pid, max(0, min(5, remaining))):
                 print("✓ Process stopped successfully")
                 if os.path.exists(pid_file):
                     os.remove(pid_file)
                 return
+            if remaining <= 5:
+                break
+            busy = package_manager_children(pid)
+            if busy:
+                print(f"Waiting for {', '.join(busy)} to finish... ({int(remaining)}s of grace left)")
+            else:
+                print(f"Waiting for process to stop... ({int(remaining)}s of grace left)")
         
         # If still running, send SIGKILL
-        print("Process not responding, sending SIGKILL...")
+        busy = package_manager_children(pid)
+        print(f"Process did not stop within {grace}s, sending SIGKILL...")
         os.kill(pid, signal.SIGKILL)
-        time.sleep(1)
+        wait_for_exit(pid, 5)
+        if busy:
+            print(f"⚠ Killed while {', '.join(busy)} was running; "
+                  f"run 'sudo dpkg --configure -a' if dpkg reports an interrupted transaction")
         
         if os.path.exists(pid_file):
             os.remove(pid_file)
@@ -845,11 +3449,11 @@ def show_summary():
     print("BACKGROUND BATCH APP INSTALLER - UBUNTU 24.04 FIXED")
     print("="*60)
     print("This script will run in the background and:")
-    print(f"1. Install 161-199 random useful apps")
-    print("2. Process apps in batches of 5-14 apps")
+    print(f"1. Install {config['total_apps'][0]}-{config['total_apps'][1]} random useful apps")
+    print(f"2. Process apps in batches of {config['batch_size'][0]}-{config['batch_size'][1]} apps")
     print("3. For each batch:")
     print("   - Install the batch")
-    print("   - Wait 7-16 minutes")
+    print(f"   - Wait {config['hold_minutes'][0]}-{config['hold_minutes'][1]} minutes")
     print("   - Uninstall the batch")
     print("4. Continue until all apps are processed")
     print("\nIMPROVEMENTS:")
@@ -859,14 +3463,167 @@ def show_summary():
     print("\nEstimated time: 1.5 to 10.5 hours")
     print(f"Log file: {log_file}")
     print(f"PID file: {pid_file}")
+    print(f"Config file: {config_file} (JSON, any of: {', '.join(sorted(config_defaults))})")
     print("="*60)
     print("\nCommands:")
     print(f"  Start:   sudo {sys.argv[0]} start")
-    print(f"  Status:  {sys.argv[0]} status")
-    print(f"  Stop:    {sys.argv[0]} stop")
+    print(f"           --config=PATH  settings file (default {config_file})")
+    print(f"           --swap  remove a batch and install the next in one apt run")
+    print(f"           --archive-budget=MB  cap for cached .debs (default 4096)")
+    print(f"           --mirror  install offline from the local mirror")
+    print(f"           --update-max-age=MIN  skip apt update for fresher lists (default 360)")
+    print(f"           --metrics-file=PATH  Prometheus textfile for node_exporter")
+    print(f"           --profile  profile with cProfile/tracemalloc ({profile_file})")
+    print(f"           --log-max-mb=MB  rotate the log into .gz archives (default 50, 0 = never)")
+    print(f"           --no-throttle  ignore host load (PSI, load average, free memory)")
+    print(f"           --libapt  use python-apt in-process (no apt timeouts)")
+    print(f"  Mirror:  sudo {sys.argv[0]} mirror [--fetch]")
+    print(f"  Simulate: {sys.argv[0]} simulate [start options] [--seed=N] [--fail-rate=F]")
+    print(f"           [--missing-rate=F] [--install-latency=S] [--remove-latency=S]")
+    print(f"           fake apt/dpkg on a virtual clock, a whole session in seconds")
+    print(f"  Status:  {sys.argv[0]} status [--json] [--follow]")
+    print(f"  Control: {sys.argv[0]} pause|resume|skip-hold")
+    print(f"  Reload:  sudo {sys.argv[0]} reload  (re-read the config file, like SIGHUP)")
+    print(f"  Stop:    {sys.argv[0]} stop [--config=PATH] [--grace=SECONDS]")
+    print(f"           let a running apt transaction finish (default {config['stop_grace_seconds']}s)")
     print(f"  Help:    {sys.argv[0]} help")
     print("="*60 + "\n")
 
+def parse_options(options):
+    """Apply start options to config; returns False on an unknown option
+    
+    The options given are remembered in config_overrides so that they
+    keep precedence over config_file.
+    """
+    global config_file
+    given = {}
+    for option in options:
+        if option.startswith('--config='):
+            # Absolute, since daemonize() changes to / before any reload
+            config_file = os.path.abspath(option.split('=', 1)[1])
+        elif option == '--swap':
+            given['swap_mode'] = True
+        elif option == '--mirror':
+            given['mirror_mode'] = True
+        elif option == '--profile':
+            given['profile'] = True
+        elif option == '--no-throttle':
+            given['throttle'] = False
+        elif option == '--libapt':
+            given['libapt'] = True
+        elif option.startswith('--update-max-age='):
+            try:
+                given['update_max_age_minutes'] = int(option.split('=', 1)[1])
+            except ValueError:
+                print(f"✗ Invalid update max age: {option}")
+                return False
+        elif option.startswith('--log-max-mb='):
+            try:
+                given['log_max_mb'] = int(option.split('=', 1)[1])
+            except ValueError:
+                print(f"✗ Invalid log size: {option}")
+                return False
+        elif option.startswith('--metrics-file='):
+            given['metrics_file'] = option.split('=', 1)[1]
+        elif option.startswith('--archive-budget='):
+            try:
+                given['archive_budget_mb'] = int(option.split('=', 1)[1])
+            except ValueError:
+                print(f"✗ Invalid archive budget: {option}")
+                return False
+        else:
+            print(f"✗ Unknown option: {option}")
+            return False
+    config.update(given)
+    config_overrides.update(given)
+    return True
+
+def run_simulation(options):
+    """Run a whole session against FakePackageBackend on a virtual clock
+    
+    Accepts the start options plus --seed, --fail-rate, --missing-rate,
+    --install-latency and --remove-latency (seconds per package). The log,
+    timings and metrics go to -sim files in /tmp, replacing the previous
+    simulation's. Load throttling is off: the real host's load says nothing
+    about the simulated one and would make --seed runs differ. Returns
+    False on bad options.
+    """
+    global clock, apt_backend, log_file, timings_file, cache_file, update_stamp_file
+    global archive_dir, apt_lists_dir, profile_file, tracemalloc_file, journal_file, control_socket
+    settings = {
+        'seed': None,
+        'fail-rate': 0.03,
+        'missing-rate': 0.05,
+        'install-latency': 20.0,
+        'remove-latency': 6.0,
+    }
+    start_options = []
+    for option in options:
+        name, _, value = option[2:].partition('=')
+        if option.startswith('--') and name in settings:
+            try:
+                settings[name] = int(value) if name == 'seed' else float(value)
+            except ValueError:
+                print(f"✗ Invalid {name}: {value}")
+                return False
+        else:
+            start_options.append(option)
+    if not parse_options(start_options):
+        return False
+    try:
+        config.update(load_config())
+    except (OSError, ValueError) as e:
+        print(f"✗ Invalid config file {config_file}: {e}")
+        return False
+    if config['mirror_mode']:
+        print("✗ --mirror cannot be simulated")
+        return False
+    config['throttle'] = False
+    
+    prefix = "/tmp/background_batch_installer-sim"
+    log_file = prefix + ".log"
+    timings_file = prefix + ".timings.jsonl"
+    cache_file = prefix + ".cache"
+    update_stamp_file = prefix + ".updated"
+    journal_file = prefix + ".journal"
+    control_socket = prefix + ".sock"
+    profile_file = prefix + ".pstats"
+    tracemalloc_file = prefix + ".tracemalloc"
+    config['metrics_file'] = config['metrics_file'] or prefix + ".prom"
+    for path in (log_file, timings_file, cache_file, update_stamp_file, journal_file, tracemalloc_file):
+        if os.path.exists(path):
+            os.remove(path)
+    # An empty lists/archive directory: every run updates and downloads
+    archive_dir = prefix + "-archives"
+    apt_lists_dir = archive_dir
+    os.makedirs(archive_dir, exist_ok=True)
+    
+    random.seed(settings['seed'])
+    clock = VirtualClock()
+    apt_backend = FakePackageBackend(
+        UBUNTU_2404_APPS,
+        seed=settings['seed'],
+        install_latency=settings['install-latency'],
+        remove_latency=settings['remove-latency'],
+        fail_rate=settings['fail-rate'],
+        missing_rate=settings['missing-rate'],
+    )
+    signal.signal(signal.SIGINT, signal_handler)
+    
+    print("Simulating a session on a virtual clock...")
+    started = time.monotonic()
+    if config['profile']:
+        run_profiled(main_installation)
+    else:
+        main_installation()
+    
+    print(f"✓ Simulated {session['batches']} batches / {session['processed_apps']} apps: "
+          f"{clock.monotonic() / 3600:.1f} h of session time in {time.monotonic() - started:.1f} s")
+    print(f"Log: {log_file}")
+    print(f"Phase timings: {timings_file}")
+    print(f"Metrics: {metrics_path()}")
+    return True
+
 def show_banner():
     """Show application banner"""
     print("""
@@ -885,6 +3642,15 @@ if __name__ == "__main__":
         command = sys.argv[1].lower()
         
         if command == "start":
+            if not parse_options(sys.argv[2:]):
+                print(f"Usage: {sys.argv[0]} start [--config=PATH] [--swap] [--mirror] [--profile] [--archive-budget=MB] [--update-max-age=MIN] [--metrics-file=PATH] [--log-max-mb=MB] [--no-throttle] [--libapt]")
+                sys.exit(1)
+            try:
+                config.update(load_config())
+            except (OSError, ValueError) as e:
+                print(f"✗ Invalid config file {config_file}: {e}")
+                sys.exit(1)
+            
             # Check if already running
             is_running, pid = check_existing_process()
             if is_running:
@@ -896,6 +3662,11 @@ if __name__ == "__main__":
             # Show summary
             show_summary()
             
+            resume = read_journal()
+            if resume is not None:
+                print(f"Unfinished session found ({resume['processed_apps']}/{resume['total_apps']} apps "
+                      f"after batch {resume['batches']}); it will be resumed.")
+            
             # Check if running as root
             if os.geteuid() != 0:
                 print("✗ This script requires sudo privileges!")
@@ -916,21 +3687,79 @@ if __name__ == "__main__":
             
             # Daemonize and start installation
             daemonize()
-            main_installation()
+            if config['profile']:
+                run_profiled(main_installation)
+            else:
+                main_installation()
+            
+        elif command == "mirror":
+            if os.geteuid() != 0:
+                print("✗ This command requires sudo privileges!")
+                sys.exit(1)
+            build_mirror(fetch_missing='--fetch' in sys.argv[2:])
+            
+        elif command == "simulate":
+            if not run_simulation(sys.argv[2:]):
+                print(f"Usage: {sys.argv[0]} simulate [start options] [--seed=N] [--fail-rate=F] [--missing-rate=F] [--install-latency=S] [--remove-latency=S]")
+                sys.exit(1)
             
         elif command == "stop":
+            grace = None
+            for option in sys.argv[2:]:
+                try:
+                    if option.startswith('--config='):
+                        config_file = os.path.abspath(option.split('=', 1)[1])
+                        continue
+                    if not option.startswith('--grace='):
+                        raise ValueError(option)
+                    grace = int(option.split('=', 1)[1])
+                except ValueError:
+                    print(f"Usage: {sys.argv[0]} stop [--config=PATH] [--grace=SECONDS]")
+                    sys.exit(1)
+            # stop_grace_seconds may come from the config file; a bad file must not block a stop
+            try:
+                config.update(load_config())
+            except (OSError, ValueError) as e:
+                print(f"⚠ Ignoring invalid config file {config_file}: {e}")
             print("Stopping background process...")
-            stop_process()
+            stop_process(grace)
             
         elif command == "status":
-            show_status()
+            show_status(as_json='--json' in sys.argv[2:], follow='--follow' in sys.argv[2:])
+            
+        elif command == "reload":
+            reply = control_request('reload')
+            if reply is not None:
+                if not reply.get('ok'):
+                    print(f"✗ Reload failed: {reply.get('error')}")
+                    sys.exit(1)
+                changes = reply.get('changes') or {}
+                print(f"✓ Config reloaded: {', '.join(f'{k}={v}' for k, v in changes.items()) or 'no changes'}")
+            else:
+                # Daemon not serving the socket yet: it reloads when its batch loop starts
+                is_running, pid = check_existing_process()
+                if not is_running:
+                    print("No background process is running")
+                    sys.exit(1)
+                os.kill(pid, signal.SIGHUP)
+                print(f"✓ Sent SIGHUP to process {pid}")
+            
+        elif command in ("pause", "resume", "skip-hold"):
+            reply = control_request(command)
+            if reply is None:
+                print("✗ Background process is not answering on its control socket")
+                sys.exit(1)
+            if not reply.get('ok'):
+                print(f"✗ {command} failed: {reply.get('error')}")
+                sys.exit(1)
+            print(f"✓ {command} sent")
             
         elif command in ["help", "--help", "-h"]:
             show_summary()
             
         else:
             print(f"✗ Unknown command: {command}")
-            print(f"Usage: {sys.argv[0]} [start|stop|status|help]")
+            print(f"Usage: {sys.argv[0]} [start|stop|status|pause|resume|skip-hold|reload|mirror|simulate|help]")
             sys.exit(1)
             
     else:
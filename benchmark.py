@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Control-plane benchmarks for background_installer.py
+Runs the installer's own code against fake apt, apt-cache and dpkg-query
+scripts on PATH, so only the daemon's overhead is measured: availability
+checks, install-state checks, the bisect fallback, log writes and the
+status command with logs from 10 KB to 1 GB.
+
+Results are saved as JSON; --compare fails on regressions against a saved
+baseline.
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+import background_installer as installer
+
+# Stand-in for apt, apt-cache and dpkg-query, dispatched on argv[0].
+# State (catalogue, installed, broken packages, call log) lives in
+# $FAKE_PM_STATE so every invocation sees the previous one's effects.
+FAKE_PM = r'''#!{python}
+import os
+import sys
+
+state = os.environ['FAKE_PM_STATE']
+tool = os.path.basename(sys.argv[0])
+
+def read(name):
+    try:
+        with open(os.path.join(state, name)) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return []
+
+args = []
+status_fd = None
+argv = sys.argv[1:]
+i = 0
+while i < len(argv):
+    if argv[i] == '-o':
+        name, _, value = argv[i + 1].partition('=')
+        if name == 'APT::Status-Fd':
+            status_fd = int(value)
+        i += 2
+        continue
+    args.append(argv[i])
+    i += 1
+
+with open(os.path.join(state, 'calls'), 'a') as f:
+    f.write(tool + ' ' + ' '.join(args[:1]) + '\n')
+
+catalogue = read('catalogue')
+known = set(catalogue)
+installed = set(read('installed'))
+names = [arg for arg in args[1:] if not arg.startswith('-')]
+
+if tool == 'apt-cache':
+    if args[0] == 'pkgnames':
+        print('\n'.join(catalogue))
+    elif args[0] == 'show':
+        for name in names:
+            if name in known:
+                print(f"Package: {name}\nVersion: 1.0-1\nSize: 102400\nInstalled-Size: 400\n")
+    elif args[0] == 'search':
+        name = names[0].strip('^$')
+        if name in known:
+            print(f"{name} - benchmark package")
+    sys.exit(0)
+
+if tool == 'dpkg-query':
+    for name in args[3:]:
+        if name in installed:
+            print(f"{name}\tinstall ok installed")
+    sys.exit(0 if all(name in installed for name in args[3:]) else 1)
+
+if tool == 'apt':
+    if args[0] not in ('install', 'remove'):
+        sys.exit(0)
+    if args[0] == 'install':
+        remove = [name[:-1] for name in names if name.endswith('-')]
+        install = [name for name in names if not name.endswith('-')]
+    else:
+        remove, install = names, []
+    status = os.fdopen(status_fd, 'w') if status_fd is not None else open(os.devnull, 'w')
+
+    for name in install:
+        if name not in known:
+            print(f"E: Unable to locate package {name}")
+            sys.exit(100)
+    for name in install:
+        if name in read('broken'):
+            print(f"dpkg: error processing package {name} (--configure):")
+            status.write(f"pmerror:{name}:50:installed {name} package post-installation script subprocess returned error exit status 1\n")
+            sys.exit(100)
+    if '--download-only' in args:
+        sys.exit(0)
+
+    for name in remove:
+        status.write(f"pmstatus:{name}:50:Removing {name}\n")
+    for name in install:
+        status.write(f"pmstatus:{name}:50:Installing {name}\n")
+    installed = (installed - set(remove)) | set(install)
+    with open(os.path.join(state, 'installed'), 'w') as f:
+        f.write('\n'.join(sorted(installed)))
+    sys.exit(0)
+
+sys.exit(0)
+'''
+
+LOG_LINE = "2026-01-01 12:00:00,000 - INFO -   [unpack 50%] Unpacking some-package (1.0-1) ...\n"
+LOG_SIZES = [('10KB', 10 * 1024), ('1MB', 1024 ** 2), ('100MB', 100 * 1024 ** 2), ('1GB', 1024 ** 3)]
+
+def setup_sandbox(workdir):
+    """Put the fake tools on PATH and point the installer's files into workdir"""
+    bin_dir = os.path.join(workdir, 'bin')
+    state_dir = os.path.join(workdir, 'state')
+    lists_dir = os.path.join(workdir, 'lists')
+    for path in (bin_dir, state_dir, lists_dir):
+        os.makedirs(path)
+
+    script = os.path.join(bin_dir, 'fakepm')
+    with open(script, 'w') as f:
+        f.write(FAKE_PM.replace('{python}', sys.executable))
+    os.chmod(script, 0o755)
+    for tool in ('apt', 'apt-cache', 'dpkg-query'):
+        os.symlink(script, os.path.join(bin_dir, tool))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_PM_STATE'] = state_dir
+
+    # Every tenth catalogue package is missing from the fake repository
+    catalogue = sorted(set(installer.UBUNTU_2404_APPS))
+    with open(os.path.join(state_dir, 'catalogue'), 'w') as f:
+        f.write('\n'.join(name for i, name in enumerate(catalogue) if i % 10))
+    with open(os.path.join(lists_dir, 'benchmark_Packages'), 'w') as f:
+        f.write('fake lists\n')
+
+    installer.apt_backend = None
+    installer.pid_file = os.path.join(workdir, 'installer.pid')
+    installer.log_file = os.path.join(workdir, 'installer.log')
+    installer.cache_file = os.path.join(workdir, 'installer.cache')
+    installer.timings_file = os.path.join(workdir, 'installer.timings.jsonl')
+    installer.update_stamp_file = os.path.join(workdir, 'installer.updated')
+    installer.apt_lists_dir = lists_dir
+    installer.archive_dir = os.path.join(workdir, 'archives')
+    # status must not reach a daemon that happens to be running on this host
+    installer.control_socket = os.path.join(workdir, 'installer.sock')
+    # ... nor wait on the real dpkg lock
+    installer.dpkg_lock_file = os.path.join(workdir, 'lock-frontend')
+    installer.config['metrics_file'] = os.path.join(workdir, 'installer.prom')
+    return state_dir
+
+def set_state(state_dir, name, packages):
+    """Replace one of the fake package manager's state files"""
+    with open(os.path.join(state_dir, name), 'w') as f:
+        f.write('\n'.join(packages))
+
+def count_calls(state_dir):
+    """Number of fake tool invocations so far"""
+    try:
+        with open(os.path.join(state_dir, 'calls')) as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+def measure(func, repeat, setup=None):
+    """Time func() repeat times (setup() is not timed); returns stats in ms"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'median_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'min_ms': round(samples[0], 3),
+        'runs': repeat,
+    }
+
+def write_log(path, size):
+    """Fill the log with size bytes of typical lines"""
+    block = LOG_LINE * (1024 * 1024 // len(LOG_LINE))
+    with open(path, 'w') as f:
+        written = 0
+        while written + len(block) <= size:
+            f.write(block)
+            written += len(block)
+        f.write(LOG_LINE * ((size - written) // len(LOG_LINE)))
+
+def run_benchmarks(workdir, quick=False, max_log_mb=1024):
+    """Run every benchmark and return {name: stats}"""
+    state_dir = setup_sandbox(workdir)
+    logger = installer.setup_logging()
+    repeat = 5 if quick else 20
+    results = {}
+
+    rng = random.Random(0)
+    catalogue = sorted(set(installer.UBUNTU_2404_APPS))
+    batch = rng.sample(catalogue, 14)
+    available = [app for app in batch if catalogue.index(app) % 10]
+
+    def reset():
+        set_state(state_dir, 'installed', [])
+        set_state(state_dir, 'broken', [])
+
+    def cold_index():
+        if os.path.exists(installer.cache_file):
+            os.remove(installer.cache_file)
+
+    print("Availability checks...")
+    results['index_build_cold'] = measure(
+        lambda: installer.load_package_index(refresh=True), repeat, setup=cold_index)
+    results['index_load_cached'] = measure(
+        lambda: installer.load_package_index(refresh=True), repeat)
+    results['availability_check_batch'] = measure(
+        lambda: installer.validate_batch(batch, 1, logger), repeat)
+
+    print("Install-state checks...")
+    set_state(state_dir, 'installed', available[::2])
+    results['state_check_batch'] = measure(
+        lambda: installer.get_installed_packages(batch), repeat)
+
+    print("Batch install/removal...")
+    results['install_batch'] = measure(
+        lambda: installer.install_batch(batch, 1, "unknown", logger), repeat, setup=reset)
+    results['uninstall_batch'] = measure(
+        lambda: installer.uninstall_batch(batch, 1, "unknown", logger), repeat,
+        setup=lambda: set_state(state_dir, 'installed', available))
+
+    def broken_batch():
+        reset()
+        set_state(state_dir, 'broken', available[-1:])
+
+    calls_before = count_calls(state_dir)
+    results['install_batch_fallback'] = measure(
+        lambda: installer.install_batch(batch, 1, "unknown", logger), repeat, setup=broken_batch)
+    results['install_batch_fallback']['tool_calls'] = (count_calls(state_dir) - calls_before) // repeat
+
+    print("Log writes...")
+    messages = 1000 if quick else 10000
+    stats = measure(lambda: [logger.info(LOG_LINE.rstrip()) for _ in range(messages)], 3)
+    results['log_write'] = {
+        'median_us': round(stats['median_ms'] * 1000 / messages, 3),
+        'messages': messages,
+        'runs': stats['runs'],
+    }
+
+    for label, size in LOG_SIZES:
+        if size > max_log_mb * 1024 * 1024:
+            continue
+        print(f"Status with a {label} log...")
+        write_log(installer.log_file, size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[f'status_log_{label}'] = measure(
+                installer.show_status, 3 if size >= 100 * 1024 ** 2 else repeat)
+        results[f'status_log_{label}']['log_bytes'] = os.path.getsize(installer.log_file)
+        os.remove(installer.log_file)
+
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print timing changes against a baseline; returns the regressed names"""
+    regressions = []
+    for name, stats in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        key = 'median_us' if 'median_us' in stats else 'median_ms'
+        if not base or key not in base:
+            print(f"  {name}: {stats[key]} (no baseline)")
+            continue
+        ratio = stats[key] / base[key] if base[key] else 1.0
+        # Ignore sub-millisecond noise on the millisecond benchmarks
+        noise = 1.0 if key == 'median_ms' else 0.0
+        regressed = ratio > 1 + tolerance and stats[key] - base[key] > noise
+        marker = '✗' if regressed else '✓'
+        print(f"  {marker} {name}: {base[key]} -> {stats[key]} ({ratio:.2f}x)")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+def main(argv):
+    quick = False
+    save = 'benchmark_results.json'
+    baseline_file = None
+    tolerance = 0.25
+    max_log_mb = 1024
+    for option in argv:
+        try:
+            if option == '--quick':
+                quick = True
+                max_log_mb = 100
+            elif option.startswith('--save='):
+                save = option.split('=', 1)[1]
+            elif option.startswith('--compare='):
+                baseline_file = option.split('=', 1)[1]
+            elif option.startswith('--tolerance='):
+                tolerance = float(option.split('=', 1)[1]) / 100
+            elif option.startswith('--max-log-mb='):
+                max_log_mb = int(option.split('=', 1)[1])
+            else:
+                raise ValueError(option)
+        except ValueError:
+            print(f"Usage: {sys.argv[0]} [--quick] [--save=FILE] [--compare=FILE] "
+                  f"[--tolerance=PCT] [--max-log-mb=MB]")
+            return 2
+
+    workdir = tempfile.mkdtemp(prefix='installer-bench-')
+    try:
+        results = run_benchmarks(workdir, quick, max_log_mb)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'quick': quick,
+        'results': results,
+    }
+    with open(save, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"✓ Results saved to {save}")
+
+    if baseline_file is None:
+        for name, stats in sorted(results.items()):
+            print(f"  {name}: {stats}")
+        return 0
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline_file} ({baseline.get('time')}, tolerance {tolerance:.0%}):")
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        print(f"✗ {len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    print("✓ No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))